@@ -0,0 +1,32 @@
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+from tests.slurm_simulator import SlurmSimulator
+
+
+@pytest.fixture
+def slurm_simulator(tmp_path, monkeypatch):
+    """Simulated slurm cluster replacing sbatch, squeue, sacct and scancel in PATH
+
+    Jobs run with the python of the tests, with an empty home directory so that the
+    user `.bashrc` is not sourced.
+    """
+    home = tmp_path / "home"
+    home.mkdir()
+    sim = SlurmSimulator(
+        state_file=tmp_path / "slurm_state.json", job_env={"HOME": str(home)}
+    )
+    bin_dir = tmp_path / "bin"
+    sim.install(bin_dir)
+    (bin_dir / "python").symlink_to(sys.executable)
+    monkeypatch.setenv("PATH", f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+    # make znamutils and the tests importable from the jobs
+    root = str(Path(__file__).parent.parent)
+    python_path = os.environ.get("PYTHONPATH")
+    monkeypatch.setenv(
+        "PYTHONPATH", root if not python_path else f"{root}{os.pathsep}{python_path}"
+    )
+    return sim
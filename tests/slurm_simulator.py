@@ -0,0 +1,1009 @@
+"""Pure python stand-in for sbatch, squeue, sacct, scancel and sinfo
+
+The simulator models partitions made of identical nodes, job arrays, dependencies,
+time limits and failures on a simulated clock. Jobs can actually execute their
+scripts, so that the scripts generated by `slurm_it` are tested end to end.
+
+Time only advances when `SlurmSimulator.run` or `SlurmSimulator.advance` is called,
+which makes tests deterministic. The state can be kept in memory, to run large scaling
+experiments in process (see `SlurmSimulator.check_output`), or in a json file shared
+by the command line tools written by `SlurmSimulator.install`.
+"""
+import contextlib
+import datetime
+import fcntl
+import getpass
+import heapq
+import json
+import math
+import os
+import random
+import re
+import shlex
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+COMMANDS = ["sbatch", "squeue", "sacct", "scancel", "sinfo"]
+ENDED_STATES = ["COMPLETED", "FAILED", "TIMEOUT", "CANCELLED"]
+SHORT_STATES = {
+    "PENDING": "PD",
+    "RUNNING": "R",
+    "COMPLETED": "CD",
+    "FAILED": "F",
+    "TIMEOUT": "TO",
+    "CANCELLED": "CA",
+}
+SHORT_OPTIONS = {
+    "-a": "array",
+    "-c": "cpus-per-task",
+    "-d": "dependency",
+    "-D": "chdir",
+    "-e": "error",
+    "-J": "job-name",
+    "-n": "ntasks",
+    "-N": "nodes",
+    "-o": "output",
+    "-p": "partition",
+    "-t": "time",
+    "-q": "qos",
+    "-A": "account",
+}
+FLAG_OPTIONS = ["parsable", "hold", "exclusive", "requeue", "no-requeue", "wait"]
+DEFAULT_PARTITIONS = {
+    "ncpu": dict(nodes=4, cpus=8, mem="64G", max_time="7-00:00:00"),
+}
+EPOCH = datetime.datetime(2024, 1, 1)
+
+
+class SlurmError(Exception):
+    """Error returned by a simulated slurm command"""
+
+
+def parse_time(time_str):
+    """Convert a slurm time string to seconds
+
+    Args:
+        time_str (str): Time as "MM", "MM:SS", "HH:MM:SS", "D-HH", "D-HH:MM" or
+            "D-HH:MM:SS". "infinite" and "UNLIMITED" are accepted.
+
+    Returns:
+        float: Number of seconds, None if unlimited
+    """
+    time_str = str(time_str).strip()
+    if time_str.lower() in ("infinite", "unlimited"):
+        return None
+    days = 0
+    if "-" in time_str:
+        days, time_str = time_str.split("-")
+        parts = [int(p) for p in time_str.split(":")]
+        parts += [0] * (3 - len(parts))
+        hours, minutes, seconds = parts
+    else:
+        parts = [int(p) for p in time_str.split(":")]
+        if len(parts) == 1:
+            hours, minutes, seconds = 0, parts[0], 0
+        elif len(parts) == 2:
+            hours, minutes, seconds = 0, parts[0], parts[1]
+        else:
+            hours, minutes, seconds = parts
+    return float(((int(days) * 24 + hours) * 60 + minutes) * 60 + seconds)
+
+
+def format_time(seconds):
+    """Format a number of seconds as a slurm time string
+
+    Args:
+        seconds (float): Number of seconds, None for unlimited
+
+    Returns:
+        str: Time as "[D-]HH:MM:SS"
+    """
+    if seconds is None:
+        return "UNLIMITED"
+    seconds = int(round(seconds))
+    days, seconds = divmod(seconds, 86400)
+    hours, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+    txt = f"{hours:02d}:{minutes:02d}:{seconds:02d}"
+    return f"{days}-{txt}" if days else txt
+
+
+def parse_mem(mem_str):
+    """Convert a slurm memory string to megabytes
+
+    Args:
+        mem_str (str): Memory, with an optional K, M, G or T suffix (default M)
+
+    Returns:
+        float: Memory in megabytes
+    """
+    mem_str = str(mem_str).strip().upper()
+    units = {"K": 1 / 1024, "M": 1, "G": 1024, "T": 1024**2}
+    if mem_str[-1] in units:
+        return float(mem_str[:-1]) * units[mem_str[-1]]
+    return float(mem_str)
+
+
+def parse_array(array_str):
+    """Parse a slurm array specification
+
+    Args:
+        array_str (str): Array, for instance "0-9", "1,3,5", "0-10:2" or "0-9%2". The
+            throttle (after %) is ignored.
+
+    Returns:
+        list: List of task IDs
+    """
+    task_ids = []
+    for part in array_str.split("%")[0].split(","):
+        step = 1
+        if ":" in part:
+            part, step = part.split(":")
+            step = int(step)
+        if "-" in part:
+            first, last = part.split("-")
+            task_ids.extend(range(int(first), int(last) + 1, step))
+        else:
+            task_ids.append(int(part))
+    return task_ids
+
+
+def parse_options(args):
+    """Parse sbatch command line options
+
+    Args:
+        args (list): Command line arguments, options first
+
+    Returns:
+        dict: Options, with long names as keys
+        list: Remaining arguments (script and script arguments)
+    """
+    options = {}
+    args = list(args)
+    while args and args[0].startswith("-"):
+        arg = args.pop(0)
+        if arg.startswith("--"):
+            key, sep, value = arg[2:].partition("=")
+            if not sep:
+                if key in FLAG_OPTIONS or key == "kill-on-invalid-dep":
+                    value = "yes" if key == "kill-on-invalid-dep" else True
+                else:
+                    value = args.pop(0)
+        else:
+            if arg[:2] not in SHORT_OPTIONS:
+                raise SlurmError(f"unrecognized option '{arg}'")
+            key = SHORT_OPTIONS[arg[:2]]
+            value = arg[2:] if len(arg) > 2 else args.pop(0)
+        options[key] = value
+    return options, args
+
+
+def parse_dependency(dependency):
+    """Parse a slurm dependency string
+
+    Args:
+        dependency (str): Dependency, for instance "afterok:12:13,afterany:14". "?"
+            separates alternative dependencies. Job IDs without a type, as in
+            "afterok:12,13", use the type of the previous condition ("afterany" if
+            first, like the old slurm format "12,13").
+
+    Returns:
+        str: "and" or "or"
+        list: List of (dependency type, list of job IDs) tuples
+    """
+    operator = "or" if "?" in dependency else "and"
+    conditions = []
+    for part in dependency.replace("?", ",").split(","):
+        dep_type, *job_ids = part.split(":")
+        if dep_type.split("_")[0].isdigit() and not job_ids:
+            job_ids = [dep_type]
+            dep_type = conditions[-1][0] if conditions else "afterany"
+        if dep_type != "singleton" and not job_ids:
+            raise SlurmError("Job dependency problem")
+        conditions.append((dep_type, [j.split("+")[0] for j in job_ids]))
+    return operator, conditions
+
+
+class SlurmSimulator:
+    """Simulated slurm cluster
+
+    Args:
+        state_file (str, optional): Json file storing the state of the simulator. If
+            None, the state is only kept in memory. Defaults to None.
+        partitions (dict, optional): Partitions of the cluster. Keys are partition
+            names, values are dictionaries with the number of `nodes`, the number of
+            `cpus` and memory `mem` of each node and the `max_time` of jobs. The first
+            partition is the default. Defaults to one "ncpu" partition of 4 nodes with 8
+            cpus and 64G of memory.
+        execute (bool, optional): Whether to execute the job scripts when jobs start.
+            Defaults to True.
+        runtime (float or callable, optional): Simulated duration of jobs in seconds, or
+            function taking the job dictionary and returning it. If None, the measured
+            duration of the script is used when executing, 60s otherwise. Callables
+            are not saved in the state file. Defaults to None.
+        failure_rate (float, optional): Probability that a job fails without running.
+            Defaults to 0.
+        seed (int, optional): Seed of the random failures. Defaults to 0.
+        job_env (dict, optional): Environment variables added to the environment of
+            executed jobs. Defaults to None.
+    """
+
+    def __init__(
+        self,
+        state_file=None,
+        partitions=None,
+        execute=True,
+        runtime=None,
+        failure_rate=0.0,
+        seed=0,
+        job_env=None,
+    ):
+        self.state_file = Path(state_file) if state_file is not None else None
+        self.config = dict(
+            partitions=partitions or DEFAULT_PARTITIONS,
+            execute=execute,
+            runtime=runtime if not callable(runtime) else None,
+            failure_rate=failure_rate,
+            seed=seed,
+            job_env=job_env or {},
+        )
+        self.runtime = runtime
+        self.clock = 0.0
+        self.next_job_id = 1
+        self.jobs = {}
+        self._rng = random.Random(seed)
+        self._reset_resources()
+        if self.state_file is not None:
+            if self.state_file.exists():
+                self._load()
+            else:
+                self._save()
+
+    # State handling
+
+    def _reset_resources(self):
+        self._free_cpus = {}
+        self._free_mem = {}
+        for name, part in self.config["partitions"].items():
+            self._free_cpus[name] = [part["cpus"]] * part["nodes"]
+            self._free_mem[name] = [parse_mem(part["mem"])] * part["nodes"]
+        self._pending = []
+        self._running = []
+
+    def _load(self):
+        with open(self.state_file) as fhandle:
+            state = json.load(fhandle)
+        self.config = state["config"]
+        self.clock = state["clock"]
+        self.next_job_id = state["next_job_id"]
+        self.jobs = {job["id"]: job for job in state["jobs"]}
+        self._rng.setstate((state["rng"][0], tuple(state["rng"][1]), state["rng"][2]))
+        if self.config["runtime"] is not None or not callable(self.runtime):
+            self.runtime = self.config["runtime"]
+        self._reset_resources()
+        for job in self.jobs.values():
+            if job["state"] == "PENDING":
+                self._pending.append(job)
+            elif job["state"] == "RUNNING":
+                self._allocate(job, job["partition"], job["alloc"])
+                heapq.heappush(
+                    self._running, (job["end_time"], job["job_id"], job["id"])
+                )
+
+    def _save(self):
+        state = dict(
+            config=self.config,
+            clock=self.clock,
+            next_job_id=self.next_job_id,
+            jobs=list(self.jobs.values()),
+            rng=self._rng.getstate(),
+        )
+        tmp_file = self.state_file.with_suffix(".tmp")
+        with open(tmp_file, "w") as fhandle:
+            json.dump(state, fhandle)
+        os.replace(tmp_file, self.state_file)
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        """Reload the state from state_file and save it back, under a file lock"""
+        if self.state_file is None:
+            yield
+            return
+        with open(str(self.state_file) + ".lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                self._load()
+                yield
+                self._save()
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    # Commands
+
+    def run_command(self, args):
+        """Run a simulated slurm command
+
+        Args:
+            args (list): Command line, for instance ["sbatch", "script.sh"]
+
+        Returns:
+            str: Standard output
+            str: Standard error
+            int: Return code
+        """
+        command, args = Path(args[0]).name, list(args[1:])
+        if command not in COMMANDS:
+            return "", f"{command}: command not found\n", 127
+        try:
+            with self._transaction():
+                out = getattr(self, f"_{command}")(args)
+        except SlurmError as err:
+            return "", f"{command}: error: {err}\n", 1
+        return out, "", 0
+
+    def check_output(self, args, **kwargs):
+        """Drop-in replacement for `subprocess.check_output` running slurm commands
+
+        Args:
+            args (list): Command line, for instance ["sbatch", "script.sh"]
+
+        Returns:
+            bytes: Standard output
+        """
+        out, err, returncode = self.run_command(args)
+        if returncode:
+            raise subprocess.CalledProcessError(returncode, args, out, err)
+        return out.encode("utf-8")
+
+    def _sbatch(self, args):
+        options, args = parse_options(args)
+        if "wrap" in options:
+            script, script_args = None, args
+        else:
+            if not args:
+                raise SlurmError("no batch script specified")
+            script, script_args = args[0], args[1:]
+            workdir = options.get("chdir", os.getcwd())
+            script = str(Path(workdir, script))
+            script_options = self._read_sbatch_lines(script)
+            options = dict(script_options, **options)
+
+        partition_names = options.get(
+            "partition", next(iter(self.config["partitions"]))
+        ).split(",")
+        ntasks = int(options.get("ntasks", 1))
+        nodes = int(options.get("nodes", 1))
+        cpus = ntasks * int(options.get("cpus-per-task", 1))
+        mem = parse_mem(options.get("mem", "1G"))
+        for name in partition_names:
+            if name not in self.config["partitions"]:
+                raise SlurmError("invalid partition specified: " + name)
+            part = self.config["partitions"][name]
+            fits = (
+                nodes <= part["nodes"]
+                and math.ceil(cpus / nodes) <= part["cpus"]
+                and mem <= parse_mem(part["mem"])
+            )
+            if not fits:
+                raise SlurmError("Requested node configuration is not available")
+        max_time = parse_time(
+            self.config["partitions"][partition_names[0]].get("max_time", "infinite")
+        )
+        time_limit = parse_time(options["time"]) if "time" in options else max_time
+        if max_time is not None and (time_limit is None or time_limit > max_time):
+            raise SlurmError("Requested time limit is invalid (missing or exceeds)")
+
+        dependency = options.get("dependency") or None
+        if dependency is not None:
+            for _, job_ids in parse_dependency(dependency)[1]:
+                for job_id in job_ids:
+                    if not self._find_jobs(job_id):
+                        raise SlurmError(
+                            "Batch job submission failed: Job dependency problem"
+                        )
+
+        name = options.get(
+            "job-name", Path(script).name if script is not None else "wrap"
+        )
+        job_id = self.next_job_id
+        task_ids = [None]
+        if "array" in options:
+            task_ids = parse_array(options["array"])
+        for i_task, task_id in enumerate(task_ids):
+            unique_id = job_id + i_task
+            job = dict(
+                id=str(job_id) if task_id is None else f"{job_id}_{task_id}",
+                job_id=unique_id,
+                array_job_id=None if task_id is None else job_id,
+                array_task_id=task_id,
+                name=name,
+                partition=",".join(partition_names),
+                script=script,
+                wrap=options.get("wrap"),
+                script_args=script_args,
+                workdir=options.get("chdir", os.getcwd()),
+                export=options.get("export", "ALL"),
+                output=options.get("output"),
+                error=options.get("error"),
+                cpus=cpus,
+                nodes=nodes,
+                mem=mem,
+                time_limit=time_limit,
+                dependency=dependency,
+                kill_on_invalid_dep=options.get("kill-on-invalid-dep") == "yes",
+                state="PENDING",
+                reason="None",
+                submit_time=self.clock,
+                start_time=None,
+                end_time=None,
+                exit_code="0:0",
+                alloc=None,
+            )
+            self.jobs[job["id"]] = job
+            self._pending.append(job)
+        self.next_job_id += len(task_ids)
+        if options.get("parsable"):
+            return f"{job_id}\n"
+        return f"Submitted batch job {job_id}\n"
+
+    def _squeue(self, args):
+        options = self._parse_query_options(
+            args, {"-j": "jobs", "-t": "states", "-o": "format"}
+        )
+        states = options.get("states", "PENDING,RUNNING").upper().split(",")
+        if "ALL" in states:
+            states = list(SHORT_STATES)
+        states = [{v: k for k, v in SHORT_STATES.items()}.get(s, s) for s in states]
+        fmt = options.get("format", "%.18i %.9P %.8j %.8u %.2t %.10M %.6D %R")
+        jobs = [
+            j for j in self._select_jobs(options.get("jobs")) if j["state"] in states
+        ]
+        lines = []
+        if not options.get("noheader"):
+            lines.append(re.sub(r"%\.?\d*(\w)", lambda m: SQUEUE_FIELDS[m[1]][0], fmt))
+        for job in jobs:
+            lines.append(
+                re.sub(r"%\.?\d*(\w)", lambda m: SQUEUE_FIELDS[m[1]][1](self, job), fmt)
+            )
+        return "".join(line + "\n" for line in lines)
+
+    def _sacct(self, args):
+        options = self._parse_query_options(args, {"-j": "jobs", "-o": "format"})
+        fmt = options.get(
+            "format", "JobID,JobName,Partition,AllocCPUS,State,ExitCode"
+        ).split(",")
+        fmt = [f.split("%")[0].lower() for f in fmt]
+        lines = []
+        if not options.get("noheader"):
+            lines.append([SACCT_FIELDS[f][0] for f in fmt])
+        for job in self._select_jobs(options.get("jobs")):
+            lines.append([SACCT_FIELDS[f][1](self, job) for f in fmt])
+        if options.get("parsable2"):
+            return "".join("|".join(line) + "\n" for line in lines)
+        if options.get("parsable"):
+            return "".join("|".join(line) + "|\n" for line in lines)
+        return "".join(" ".join(f"{v:>12}" for v in line) + "\n" for line in lines)
+
+    def _scancel(self, args):
+        job_ids = [a for a in args if not a.startswith("-")]
+        if not job_ids:
+            raise SlurmError("No job identification provided")
+        for job_id in job_ids:
+            jobs = self._find_jobs(job_id)
+            if not jobs:
+                raise SlurmError(f"Invalid job id specified: {job_id}")
+            for job in jobs:
+                self._cancel(job)
+        return ""
+
+    def _sinfo(self, args):
+        options = self._parse_query_options(args, {"-o": "format"})
+        fmt = options.get("format", "%P %a %l %D %t %N")
+        lines = []
+        if not options.get("noheader"):
+            lines.append(re.sub(r"%\.?\d*(\w)", lambda m: SINFO_FIELDS[m[1]][0], fmt))
+        for name, part in self.config["partitions"].items():
+            nodes = list(range(part["nodes"]))
+            groups = [[i] for i in nodes] if options.get("node_oriented") else [nodes]
+            for group in groups:
+                lines.append(
+                    re.sub(
+                        r"%\.?\d*(\w)",
+                        lambda m: SINFO_FIELDS[m[1]][1](self, name, group),
+                        fmt,
+                    )
+                )
+        return "".join(line + "\n" for line in lines)
+
+    # Simulation
+
+    def run(self, until=None):
+        """Run the simulation
+
+        Jobs are started in submission order as soon as their dependencies are
+        satisfied and resources are available, later jobs filling the gaps.
+
+        Args:
+            until (float, optional): Simulated time at which to stop. If None, run
+                until no job is running and no pending job can start. Defaults to
+                None.
+        """
+        with self._transaction():
+            while True:
+                self._schedule()
+                if not self._running:
+                    break
+                next_end = self._running[0][0]
+                if until is not None and next_end > until:
+                    break
+                self.clock = max(self.clock, next_end)
+                while self._running and self._running[0][0] <= self.clock:
+                    _, _, job_id = heapq.heappop(self._running)
+                    self._finish(self.jobs[job_id])
+            if until is not None:
+                self.clock = max(self.clock, until)
+
+    def advance(self, seconds):
+        """Run the simulation for some simulated time
+
+        Args:
+            seconds (float): Simulated time to advance the clock by
+        """
+        self.run(until=self.clock + seconds)
+
+    def queue_wait_times(self):
+        """Time between submission and start of all started jobs
+
+        Returns:
+            dict: Simulated wait time in seconds for each job ID
+        """
+        with self._transaction():
+            return {
+                job["id"]: job["start_time"] - job["submit_time"]
+                for job in self.jobs.values()
+                if job["start_time"] is not None
+            }
+
+    def job(self, job_id):
+        """Get the record of a job
+
+        Args:
+            job_id (str): Job ID, with task ID for array tasks
+
+        Returns:
+            dict: Job record
+        """
+        with self._transaction():
+            return dict(self.jobs[str(job_id)])
+
+    def _schedule(self):
+        still_pending, not_visited = [], []
+        for i_job, job in enumerate(self._pending):
+            if job["state"] != "PENDING":
+                continue
+            if not any(c for cpus in self._free_cpus.values() for c in cpus):
+                # the cluster is full, no need to look further
+                job["reason"] = "Resources"
+                not_visited = self._pending[i_job:]
+                break
+            status = self._dependency_status(job)
+            if status == "never":
+                if job["kill_on_invalid_dep"]:
+                    self._cancel(job)
+                    continue
+                job["reason"] = "DependencyNeverSatisfied"
+            elif status == "wait":
+                job["reason"] = "Dependency"
+            else:
+                for partition in job["partition"].split(","):
+                    alloc = self._find_nodes(job, partition)
+                    if alloc is not None:
+                        self._start(job, partition, alloc)
+                        break
+                else:
+                    job["reason"] = "Resources"
+            if job["state"] == "PENDING":
+                still_pending.append(job)
+        self._pending = still_pending + not_visited
+
+    def _find_nodes(self, job, partition):
+        cpus = math.ceil(job["cpus"] / job["nodes"])
+        alloc = []
+        for i_node, (free_cpus, free_mem) in enumerate(
+            zip(self._free_cpus[partition], self._free_mem[partition])
+        ):
+            if free_cpus >= cpus and free_mem >= job["mem"]:
+                alloc.append(i_node)
+                if len(alloc) == job["nodes"]:
+                    return alloc
+        return None
+
+    def _allocate(self, job, partition, alloc, release=False):
+        sign = 1 if release else -1
+        cpus = math.ceil(job["cpus"] / job["nodes"])
+        for i_node in alloc:
+            self._free_cpus[partition][i_node] += sign * cpus
+            self._free_mem[partition][i_node] += sign * job["mem"]
+
+    def _start(self, job, partition, alloc):
+        self._allocate(job, partition, alloc)
+        job.update(
+            state="RUNNING",
+            reason="None",
+            partition=partition,
+            alloc=alloc,
+            start_time=self.clock,
+        )
+        returncode = 0
+        duration = None
+        if self._rng.random() < self.config["failure_rate"]:
+            returncode = 1
+        elif self.config["execute"]:
+            start = time.time()
+            returncode = self._execute(job)
+            duration = time.time() - start
+        if callable(self.runtime):
+            duration = self.runtime(job)
+        elif self.runtime is not None:
+            duration = self.runtime
+        elif duration is None:
+            duration = 60.0
+        if job["time_limit"] is not None and duration > job["time_limit"]:
+            job.update(final_state="TIMEOUT", exit_code="0:15")
+            duration = job["time_limit"]
+        elif returncode:
+            job.update(final_state="FAILED", exit_code=f"{returncode}:0")
+        else:
+            job.update(final_state="COMPLETED", exit_code="0:0")
+        job["end_time"] = self.clock + duration
+        heapq.heappush(self._running, (job["end_time"], job["job_id"], job["id"]))
+
+    def _finish(self, job):
+        self._allocate(job, job["partition"], job["alloc"], release=True)
+        job["state"] = job.pop("final_state")
+
+    def _cancel(self, job):
+        if job["state"] == "RUNNING":
+            self._allocate(job, job["partition"], job["alloc"], release=True)
+            self._running = [r for r in self._running if r[2] != job["id"]]
+            heapq.heapify(self._running)
+            job.pop("final_state", None)
+        elif job["state"] != "PENDING":
+            return
+        job.update(state="CANCELLED", end_time=self.clock, exit_code="0:0")
+
+    def _execute(self, job):
+        env = dict(os.environ)
+        env.update(self.config["job_env"])
+        if job["export"] not in ("ALL", "NONE"):
+            exports = job["export"].split(",")
+            env.update(e.split("=", 1) for e in exports if "=" in e)
+        env.update(
+            SLURM_JOB_ID=str(job["job_id"]),
+            SLURM_JOB_NAME=job["name"],
+            SLURM_JOB_PARTITION=job["partition"],
+            SLURM_CPUS_ON_NODE=str(math.ceil(job["cpus"] / job["nodes"])),
+            SLURM_SUBMIT_DIR=job["workdir"],
+        )
+        if job["array_job_id"] is not None:
+            env.update(
+                SLURM_ARRAY_JOB_ID=str(job["array_job_id"]),
+                SLURM_ARRAY_TASK_ID=str(job["array_task_id"]),
+            )
+        if job["wrap"] is not None:
+            cmd = ["bash", "-c", job["wrap"]]
+        else:
+            cmd = ["bash", job["script"]] + job["script_args"]
+        default_output = "slurm-%j.out" if job["array_job_id"] is None else None
+        output = self._output_path(
+            job, job["output"] or default_output or "slurm-%A_%a.out"
+        )
+        error = self._output_path(job, job["error"]) if job["error"] else output
+        with contextlib.ExitStack() as stack:
+            stdout = stack.enter_context(open(output, "w"))
+            stderr = stdout
+            if error != output:
+                stderr = stack.enter_context(open(error, "w"))
+            return subprocess.call(
+                cmd, cwd=job["workdir"], env=env, stdout=stdout, stderr=stderr
+            )
+
+    def _output_path(self, job, pattern):
+        replacements = {
+            "%j": str(job["job_id"]),
+            "%A": str(job["array_job_id"] or job["job_id"]),
+            "%a": str(job["array_task_id"]),
+            "%x": job["name"],
+            "%u": getpass.getuser(),
+        }
+        for key, value in replacements.items():
+            pattern = pattern.replace(key, value)
+        return str(Path(job["workdir"], pattern))
+
+    def _dependency_status(self, job):
+        if job["dependency"] is None:
+            return "ok"
+        operator, conditions = parse_dependency(job["dependency"])
+        statuses = []
+        for dep_type, job_ids in conditions:
+            if dep_type == "singleton":
+                running = [
+                    j
+                    for j in self.jobs.values()
+                    if j["name"] == job["name"]
+                    and j["state"] == "RUNNING"
+                    and j["id"] != job["id"]
+                ]
+                statuses.append("wait" if running else "ok")
+                continue
+            for job_id in job_ids:
+                deps = self._find_jobs(job_id)
+                if dep_type == "aftercorr" and job["array_task_id"] is not None:
+                    deps = [
+                        d
+                        for d in deps
+                        if d["array_task_id"] in (None, job["array_task_id"])
+                    ]
+                statuses.extend(self._condition_status(dep_type, d) for d in deps)
+        if operator == "or":
+            if "ok" in statuses:
+                return "ok"
+            return "never" if all(s == "never" for s in statuses) else "wait"
+        if "never" in statuses:
+            return "never"
+        return "ok" if all(s == "ok" for s in statuses) else "wait"
+
+    @staticmethod
+    def _condition_status(dep_type, dep):
+        ended = dep["state"] in ENDED_STATES
+        if dep_type == "after":
+            return "ok" if dep["state"] != "PENDING" else "wait"
+        if dep_type == "afterany":
+            return "ok" if ended else "wait"
+        if dep_type in ("afterok", "aftercorr"):
+            if not ended:
+                return "wait"
+            return "ok" if dep["state"] == "COMPLETED" else "never"
+        if dep_type == "afternotok":
+            if not ended:
+                return "wait"
+            return "never" if dep["state"] == "COMPLETED" else "ok"
+        raise SlurmError(f"Unknown dependency type {dep_type}")
+
+    # Helpers
+
+    def _find_jobs(self, job_id):
+        job_id = str(job_id)
+        if job_id in self.jobs:
+            return [self.jobs[job_id]]
+        return [
+            j
+            for j in self.jobs.values()
+            if str(j["array_job_id"]) == job_id or str(j["job_id"]) == job_id
+        ]
+
+    def _select_jobs(self, job_ids):
+        if job_ids is None:
+            return sorted(self.jobs.values(), key=lambda j: j["job_id"])
+        jobs = []
+        for job_id in job_ids.split(","):
+            jobs.extend(j for j in self._find_jobs(job_id) if j not in jobs)
+        return jobs
+
+    @staticmethod
+    def _read_sbatch_lines(script):
+        if not Path(script).exists():
+            raise SlurmError(f"Unable to open file {script}")
+        args = []
+        with open(script) as fhandle:
+            for line in fhandle:
+                line = line.strip()
+                if line.startswith("#SBATCH"):
+                    args.extend(shlex.split(line[len("#SBATCH") :]))
+                elif line and not line.startswith("#"):
+                    break
+        return parse_options(args)[0]
+
+    @staticmethod
+    def _parse_query_options(args, short_options):
+        flags = {
+            "-h": "noheader",
+            "--noheader": "noheader",
+            "-n": "noheader",
+            "-P": "parsable2",
+            "--parsable2": "parsable2",
+            "-p": "parsable",
+            "--parsable": "parsable",
+            "-X": "allocations",
+            "--allocations": "allocations",
+            "-N": "node_oriented",
+            "--Node": "node_oriented",
+        }
+        options = {}
+        args = list(args)
+        while args:
+            arg = args.pop(0)
+            if arg in flags:
+                options[flags[arg]] = True
+            elif arg.startswith("--"):
+                key, sep, value = arg[2:].partition("=")
+                options[key] = value if sep else args.pop(0)
+            elif arg[:2] in short_options:
+                value = arg[2:] if len(arg) > 2 else args.pop(0)
+                options[short_options[arg[:2]]] = value
+            elif arg.startswith("-"):
+                # options that are irrelevant here, such as -u USER
+                args.pop(0)
+        return options
+
+    def _timestamp(self, seconds):
+        if seconds is None:
+            return "Unknown"
+        return (EPOCH + datetime.timedelta(seconds=seconds)).isoformat(
+            timespec="seconds"
+        )
+
+    def _elapsed(self, job):
+        if job["start_time"] is None:
+            return 0.0
+        end = job["end_time"] if job["state"] in ENDED_STATES else self.clock
+        return end - job["start_time"]
+
+    def _reason(self, job):
+        if job["state"] == "PENDING":
+            return f"({job['reason']})"
+        if job["alloc"] is None:
+            return ""
+        return ",".join(f"{job['partition']}-{i:03d}" for i in job["alloc"])
+
+    def _node_state(self, partition, nodes):
+        cpus = self.config["partitions"][partition]["cpus"]
+        free = [self._free_cpus[partition][i] for i in nodes]
+        if all(f == cpus for f in free):
+            return "idle"
+        if not any(free):
+            return "alloc"
+        return "mix"
+
+    def _cpu_states(self, partition, nodes):
+        total = self.config["partitions"][partition]["cpus"] * len(nodes)
+        idle = sum(self._free_cpus[partition][i] for i in nodes)
+        return f"{total - idle}/{idle}/0/{total}"
+
+    def install(self, bin_dir):
+        """Write executables for sbatch, squeue, sacct, scancel and sinfo in bin_dir
+
+        The executables run the simulator on `state_file`. Add bin_dir at the start of
+        PATH to use them in place of slurm.
+
+        Args:
+            bin_dir (str): Folder to write the executables to
+        """
+        assert self.state_file is not None, "A state_file is required to install"
+        bin_dir = Path(bin_dir)
+        bin_dir.mkdir(parents=True, exist_ok=True)
+        for command in COMMANDS:
+            executable = bin_dir / command
+            executable.write_text(
+                f"#!{sys.executable}\n"
+                + "import sys\n"
+                + f"sys.path.insert(0, {repr(str(Path(__file__).parent))})\n"
+                + "from slurm_simulator import main\n"
+                + f"sys.exit(main([{repr(command)}] + sys.argv[1:], "
+                + f"{repr(str(self.state_file.resolve()))}))\n"
+            )
+            executable.chmod(0o755)
+
+
+SQUEUE_FIELDS = {
+    "i": ("JOBID", lambda sim, job: job["id"]),
+    "A": ("JOBID", lambda sim, job: str(job["array_job_id"] or job["job_id"])),
+    "a": ("TASK_ID", lambda sim, job: str(job["array_task_id"] or "N/A")),
+    "j": ("NAME", lambda sim, job: job["name"]),
+    "P": ("PARTITION", lambda sim, job: job["partition"]),
+    "u": ("USER", lambda sim, job: getpass.getuser()),
+    "t": ("ST", lambda sim, job: SHORT_STATES[job["state"]]),
+    "T": ("STATE", lambda sim, job: job["state"]),
+    "M": ("TIME", lambda sim, job: format_time(sim._elapsed(job))),
+    "l": ("TIME_LIMIT", lambda sim, job: format_time(job["time_limit"])),
+    "L": (
+        "TIME_LEFT",
+        lambda sim, job: format_time(
+            job["time_limit"] - sim._elapsed(job)
+            if job["time_limit"] is not None
+            else None
+        ),
+    ),
+    "D": ("NODES", lambda sim, job: str(job["nodes"])),
+    "C": ("CPUS", lambda sim, job: str(job["cpus"])),
+    "m": ("MIN_MEMORY", lambda sim, job: f"{job['mem']:.0f}M"),
+    "r": ("REASON", lambda sim, job: job["reason"]),
+    "R": ("NODELIST(REASON)", lambda sim, job: sim._reason(job)),
+    "V": ("SUBMIT_TIME", lambda sim, job: sim._timestamp(job["submit_time"])),
+    "S": ("START_TIME", lambda sim, job: sim._timestamp(job["start_time"])),
+}
+SINFO_FIELDS = {
+    "P": (
+        "PARTITION",
+        lambda sim, name, nodes: name
+        + ("*" if name == next(iter(sim.config["partitions"])) else ""),
+    ),
+    "a": ("AVAIL", lambda sim, name, nodes: "up"),
+    "l": (
+        "TIMELIMIT",
+        lambda sim, name, nodes: format_time(
+            parse_time(sim.config["partitions"][name].get("max_time", "infinite"))
+        ),
+    ),
+    "D": ("NODES", lambda sim, name, nodes: str(len(nodes))),
+    "t": ("STATE", lambda sim, name, nodes: sim._node_state(name, nodes)),
+    "n": (
+        "HOSTNAMES",
+        lambda sim, name, nodes: ",".join(f"{name}-{i:03d}" for i in nodes),
+    ),
+    "N": (
+        "NODELIST",
+        lambda sim, name, nodes: ",".join(f"{name}-{i:03d}" for i in nodes),
+    ),
+    "c": ("CPUS", lambda sim, name, nodes: str(sim.config["partitions"][name]["cpus"])),
+    "m": (
+        "MEMORY",
+        lambda sim, name, nodes: "{:.0f}".format(
+            parse_mem(sim.config["partitions"][name]["mem"])
+        ),
+    ),
+    "C": ("CPUS(A/I/O/T)", lambda sim, name, nodes: sim._cpu_states(name, nodes)),
+    "e": (
+        "FREE_MEM",
+        lambda sim, name, nodes: f"{sum(sim._free_mem[name][i] for i in nodes):.0f}",
+    ),
+}
+SACCT_FIELDS = {
+    "jobid": ("JobID", lambda sim, job: job["id"]),
+    "jobidraw": ("JobIDRaw", lambda sim, job: str(job["job_id"])),
+    "jobname": ("JobName", lambda sim, job: job["name"]),
+    "partition": ("Partition", lambda sim, job: job["partition"]),
+    "alloccpus": ("AllocCPUS", lambda sim, job: str(job["cpus"])),
+    "reqmem": ("ReqMem", lambda sim, job: f"{job['mem']:.0f}M"),
+    "state": ("State", lambda sim, job: job["state"]),
+    "exitcode": ("ExitCode", lambda sim, job: job["exit_code"]),
+    "submit": ("Submit", lambda sim, job: sim._timestamp(job["submit_time"])),
+    "start": ("Start", lambda sim, job: sim._timestamp(job["start_time"])),
+    "end": (
+        "End",
+        lambda sim, job: sim._timestamp(
+            job["end_time"] if job["state"] in ENDED_STATES else None
+        ),
+    ),
+    "elapsed": ("Elapsed", lambda sim, job: format_time(sim._elapsed(job))),
+    "elapsedraw": ("ElapsedRaw", lambda sim, job: str(int(sim._elapsed(job)))),
+    "timelimit": ("Timelimit", lambda sim, job: format_time(job["time_limit"])),
+    "nodelist": (
+        "NodeList",
+        lambda sim, job: sim._reason(job) if job["state"] != "PENDING" else "None",
+    ),
+}
+
+
+def main(argv, state_file=None):
+    """Entry point of the command line tools written by `SlurmSimulator.install`
+
+    Args:
+        argv (list): Command line, starting with the command name
+        state_file (str, optional): State file of the simulator. Defaults to the
+            SLURM_SIMULATOR_STATE environment variable.
+
+    Returns:
+        int: Return code
+    """
+    state_file = state_file or os.environ["SLURM_SIMULATOR_STATE"]
+    out, err, returncode = SlurmSimulator(state_file).run_command(argv)
+    sys.stdout.write(out)
+    sys.stderr.write(err)
+    return returncode
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -1,18 +1,49 @@
 import time
-from pathlib import Path
 
-from znamutils import slurm_it
+import pytest
 
-try:
-    import flexiznam as flz
-except ImportError:
-    raise ImportError("flexiznam is required to run this test")
+from znamutils import slurm_helper, slurm_it
 
 
-def test_slurm_my_func():
-    slurm_folder = (
-        Path(flz.PARAMETERS["data_root"]["processed"]) / "test" / "test_slurm_it"
-    )
+@slurm_it(conda_env="cottage_analysis", slurm_options={"time": "00:01:00"})
+def slow_func(a, b):
+    time.sleep(0.1)
+    return a + b
+
+
+@slurm_it(conda_env="cottage_analysis", slurm_options={"time": "00:01:00"})
+def batch_test_func(tardir, a=None, b=None):
+    target = str(tardir) + f"/test_{a}.txt"
+    with open(target, "w") as f:
+        f.write(f"{a} {b}")
+    return target
+
+
+@slurm_it(conda_env="cottage_analysis", inputs="source", outputs="target")
+def copy_file(source, target, suffix=""):
+    with open(source) as f_in, open(target, "w") as f_out:
+        f_out.write(f_in.read() + suffix)
+    return target
+
+
+@slurm_it(conda_env="cottage_analysis", profile="cprofile")
+def cprofiled_func(n=None):
+    return sum(range(int(n)))
+
+
+@slurm_it(conda_env="cottage_analysis", profile="tracemalloc")
+def tracemalloced_func(n=None):
+    return list(range(int(n)))
+
+
+@slurm_it(conda_env="cottage_analysis", bundle_code=True)
+def bundled_func(target=None):
+    with open(target, "w") as f:
+        f.write(__file__)
+
+
+def test_slurm_my_func(tmp_path, slurm_simulator):
+    slurm_folder = tmp_path / "test_slurm_it"
     slurm_folder.mkdir(exist_ok=True)
 
     @slurm_it(conda_env="cottage_analysis")
@@ -36,10 +67,8 @@ def test_slurm_my_func():
     assert out == 3
     # using slurm
     out = test_func(1, 2, use_slurm=True, slurm_folder=slurm_folder)
-    sbatch_file = slurm_folder / "test_func.sh"
-    assert sbatch_file.exists()
-    python_file = slurm_folder / "test_func.py"
-    assert python_file.exists()
+    assert len(list(slurm_folder.glob("test_func_*.sh"))) == 2
+    assert len(list(slurm_folder.glob("test_func_args_*.py"))) == 1
 
     assert isinstance(out, str)
     # wait for previous job to finish
@@ -50,8 +79,7 @@ def test_slurm_my_func():
         scripts_name="test_func_renamed",
         slurm_folder=slurm_folder,
     )
-    sbatch_file = slurm_folder / "test_func_renamed.sh"
-    assert sbatch_file.exists()
+    assert len(list(slurm_folder.glob("test_func_renamed_*.sh"))) == 1
 
     # rename the slurm script
     test_func(
@@ -62,8 +90,7 @@ def test_slurm_my_func():
         job_dependency=out,
         slurm_folder=slurm_folder,
     )
-    sbatch_file = slurm_folder / "test_func_with_dep.sh"
-    assert sbatch_file.exists()
+    assert len(list(slurm_folder.glob("test_func_with_dep_*.sh"))) == 1
 
     @slurm_it(
         conda_env="cottage_analysis",
@@ -87,22 +114,24 @@ def test_slurm_my_func():
         job_dependency=out,
         slurm_folder=slurm_folder,
     )
-    python_file = slurm_folder / "test_func_with_dep.py"
-    assert python_file.exists()
-    txt = python_file.read_text()
+    python_files = slurm_folder.glob("test_func_with_dep_*.py")
+    txt = "".join(f.read_text() for f in python_files if "_args_" not in f.name)
     assert "import numpy" in txt
     assert "from pandas import Dataframe" in txt
 
 
-def test_dependencies():
-    slurm_folder = (
-        Path(flz.PARAMETERS["data_root"]["processed"]) / "test" / "test_slurm_it"
+def test_slurm_job_runs(tmp_path, slurm_simulator):
+    job_id = batch_test_func(
+        str(tmp_path), a=1, b=2, use_slurm=True, slurm_folder=tmp_path
     )
+    assert slurm_simulator.job(job_id)["state"] == "PENDING"
+    slurm_simulator.run()
+    assert slurm_simulator.job(job_id)["state"] == "COMPLETED"
+    assert (tmp_path / "test_1.txt").read_text() == "1 2"
 
-    @slurm_it(conda_env="cottage_analysis")
-    def slow_func(a, b):
-        time.sleep(2)
-        return a + b
+
+def test_dependencies(tmp_path, slurm_simulator):
+    slurm_folder = tmp_path
 
     o1 = slow_func(1, 2, use_slurm=True, slurm_folder=slurm_folder)
     o2 = slow_func(1, 2, use_slurm=True, slurm_folder=slurm_folder, job_dependency=o1)
@@ -117,7 +146,7 @@ def test_dependencies():
         job_dependency=",".join([o1, o2, o3]),
     )
     # it work with a list
-    slow_func(
+    o5 = slow_func(
         1,
         2,
         use_slurm=True,
@@ -125,19 +154,67 @@ def test_dependencies():
         job_dependency=[o1, o2, o3, o4],
     )
     # it works with empty list
-    slow_func(
+    o6 = slow_func(
         1,
         2,
         use_slurm=True,
         slurm_folder=slurm_folder,
         job_dependency=[],
     )
+    assert slurm_simulator.job(o3)["dependency"] == f"afterok:{o1}:{o2}"
+    slurm_simulator.run()
+    for job_id in [o1, o2, o3, o4, o5, o6]:
+        assert slurm_simulator.job(job_id)["state"] == "COMPLETED"
+    jobs = [slurm_simulator.job(job_id) for job_id in [o1, o2, o3, o5]]
+    for previous, job in zip(jobs[:-1], jobs[1:]):
+        assert job["start_time"] >= previous["end_time"]
 
 
-def test_update_slurm_options():
-    slurm_folder = (
-        Path(flz.PARAMETERS["data_root"]["processed"]) / "test" / "test_slurm_it"
+def test_large_dependencies(tmp_path, slurm_simulator):
+    job_ids = batch_test_func(
+        str(tmp_path),
+        use_slurm=True,
+        slurm_folder=tmp_path,
+        batch_param_list=[[i, i] for i in range(5)],
+        batch_param_names=["a", "b"],
+    )
+
+    @slurm_it(conda_env="cottage_analysis", max_dependencies=2)
+    def test_func(a, b):
+        return a + b
+
+    # 5 dependencies with at most 2 per job require 3 + 2 barriers
+    final = test_func(
+        1, 2, use_slurm=True, slurm_folder=tmp_path, job_dependency=job_ids
+    )
+    assert int(final) == int(job_ids[-1]) + 6
+    barriers = [int(job_ids[-1]) + i for i in range(1, 6)]
+    for barrier in barriers:
+        assert slurm_simulator.job(barrier)["name"] == "barrier"
+        assert slurm_simulator.job(barrier)["partition"] == "ncpu"
+    dependency = f"afterok:{barriers[-2]}:{barriers[-1]}"
+    assert slurm_simulator.job(final)["dependency"] == dependency
+    slurm_simulator.run()
+    assert slurm_simulator.job(final)["start_time"] >= max(
+        slurm_simulator.job(j)["end_time"] for j in job_ids
+    )
+
+    # aftercorr with batch jobs depends on the matching element only
+    corr_ids = batch_test_func(
+        str(tmp_path),
+        use_slurm=True,
+        slurm_folder=tmp_path,
+        batch_param_list=[[i, i] for i in range(5)],
+        batch_param_names=["a", "b"],
+        dependency_type="aftercorr",
+        job_dependency=job_ids,
     )
+    for job_id, corr_id in zip(job_ids, corr_ids):
+        assert slurm_simulator.job(corr_id)["dependency"] == f"afterok:{job_id}"
+
+
+def test_update_slurm_options(tmp_path, slurm_simulator):
+    slurm_folder = tmp_path / "test_slurm_it"
     slurm_folder.mkdir(exist_ok=True)
 
     @slurm_it(conda_env="cottage_analysis", slurm_options={"time": "00:01:00"})
@@ -149,33 +226,25 @@ def test_update_slurm_options():
         print(datetime.now())
         return a + b
 
-    test_func(1, 2, use_slurm=True, slurm_folder=slurm_folder)
-    sbatch_file = slurm_folder / "test_func.sh"
-    assert sbatch_file.exists()
-    with open(sbatch_file, "r") as f:
-        txt = f.read()
-        assert "#SBATCH --time=00:01:00" in txt
-    test_func(
+    job_id = test_func(1, 2, use_slurm=True, slurm_folder=slurm_folder)
+    assert slurm_simulator.job(job_id)["time_limit"] == 60
+    job_id = test_func(
         1,
         2,
         use_slurm=True,
         slurm_folder=slurm_folder,
         slurm_options={"time": "00:02:00"},
     )
-    with open(sbatch_file, "r") as f:
-        txt = f.read()
-        assert "#SBATCH --time=00:02:00" in txt
+    assert slurm_simulator.job(job_id)["time_limit"] == 120
+    # the first script is not overwritten
+    sbatch_files = sorted(slurm_folder.glob("test_func_*.sh"))
+    txt = "".join(f.read_text() for f in sbatch_files)
+    assert "#SBATCH --time=00:01:00" in txt
+    assert "#SBATCH --time=00:02:00" in txt
 
 
-def test_batch_run(tmpdir):
-    @slurm_it(conda_env="cottage_analysis", slurm_options={"time": "00:01:00"})
-    def batch_test_func(tardir, a=None, b=None):
-        target = str(tardir) + f"/test_{a}.txt"
-        with open(target, "w") as f:
-            f.write(f"{a} {b}")
-        return target
-
-    batch_test_func(
+def test_batch_run(tmpdir, slurm_simulator):
+    job_ids = batch_test_func(
         str(tmpdir),
         use_slurm=True,
         scripts_name="batch_test_func_with_dep",
@@ -183,28 +252,153 @@ def test_batch_run(tmpdir):
         batch_param_list=[[1, 2], [3, 4]],
         batch_param_names=["a", "b"],
     )
-    sh_file = tmpdir / "batch_test_func_with_dep.sh"
-    assert sh_file.exists()
-    with open(sh_file, "r") as f:
-        txt = f.read()
-    assert "batch_test_func_with_dep.py --a $a --b $b" in txt
-    python_file = tmpdir / "batch_test_func_with_dep.py"
-    assert python_file.exists()
-    with open(python_file, "r") as f:
-        txt = f.read()
+    (sh_file,) = tmpdir.listdir("batch_test_func_with_dep_*.sh")
+    (payload,) = tmpdir.listdir("batch_test_func_with_dep_args_*.py")
+    python_file = [
+        f for f in tmpdir.listdir("batch_test_func_with_dep_*.py") if f != payload
+    ][0]
+    assert f'{python_file} --a $a --b $b "$@"' in sh_file.read_text("utf-8")
     lines = [
         "import argparse",
+        "import runpy",
         "",
         "from tests.test_decorators import batch_test_func",
         "",
         "parser = argparse.ArgumentParser()",
         "parser.add_argument('--a')",
         "parser.add_argument('--b')",
+        "parser.add_argument('--payload')",
         "args = parser.parse_args()",
         "",
-        f"batch_test_func(tardir='{str(tmpdir)}', use_slurm=False, a=args.a, b=args.b, "
-        + ")",
+        "_arguments = runpy.run_path(args.payload, init_globals=globals())"
+        + '["arguments"]',
+        "batch_test_func(**_arguments, a=args.a, b=args.b, )",
+        "",
+    ]
+    assert python_file.read_text("utf-8").split("\n") == lines
+    lines = [
+        "arguments = {",
+        f"    'tardir': '{str(tmpdir)}',",
+        "    'use_slurm': False,",
+        "}",
         "",
     ]
-    for expected, actual in zip(lines, txt.split("\n")):
-        assert expected == actual, f"{expected} != {actual}"
+    assert payload.read_text("utf-8").split("\n") == lines
+    for job_id in job_ids:
+        assert slurm_simulator.job(job_id)["script_args"] == ["--payload", str(payload)]
+
+    slurm_simulator.run()
+    for job_id in job_ids:
+        assert slurm_simulator.job(job_id)["state"] == "COMPLETED"
+    assert (tmpdir / "test_1.txt").read_text("utf-8") == "1 2"
+    assert (tmpdir / "test_3.txt").read_text("utf-8") == "3 4"
+
+
+def test_incremental_local(tmp_path):
+    source = tmp_path / "source.txt"
+    target = tmp_path / "target.txt"
+    source.write_text("a")
+    assert copy_file(source, target) == target
+    assert target.read_text() == "a"
+    # up to date, the function does not run
+    assert copy_file(source, target) is None
+    # other arguments changed
+    assert copy_file(source, target, suffix="b") == target
+    assert copy_file(source, target, suffix="b") is None
+    # input changed
+    source.write_text("aa")
+    assert copy_file(source, target, suffix="b") == target
+    assert target.read_text() == "aab"
+    # output deleted
+    target.unlink()
+    assert copy_file(source, target, suffix="b") == target
+
+    with pytest.raises(ValueError):
+
+        @slurm_it(conda_env="cottage_analysis", outputs="target", file_check="size")
+        def bad_check(target):
+            return target
+
+
+def test_incremental_slurm(tmp_path, slurm_simulator):
+    source = tmp_path / "source.txt"
+    middle = tmp_path / "middle.txt"
+    target = tmp_path / "target.txt"
+    source.write_text("a")
+
+    def pipeline():
+        # both calls share the same scripts, with different payloads
+        first = copy_file(source, middle, use_slurm=True, slurm_folder=tmp_path)
+        second = copy_file(
+            middle,
+            target,
+            use_slurm=True,
+            slurm_folder=tmp_path,
+            job_dependency=[first],
+        )
+        slurm_simulator.run()
+        return first, second
+
+    first, second = pipeline()
+    assert slurm_simulator.job(second)["dependency"] == f"afterok:{first}"
+    assert slurm_simulator.job(second)["state"] == "COMPLETED"
+    assert target.read_text() == "a"
+    # nothing changed, nothing is submitted
+    assert pipeline() == (None, None)
+    # the first step is out of date, the second is submitted after it
+    source.write_text("bb")
+    first, second = pipeline()
+    assert first is not None
+    assert slurm_simulator.job(second)["dependency"] == f"afterok:{first}"
+    assert target.read_text() == "bb"
+    # only the second step is out of date
+    target.write_text("modified")
+    first, second = pipeline()
+    assert first is None
+    assert slurm_simulator.job(second)["dependency"] is None
+    assert target.read_text() == "bb"
+
+    # batch jobs only submit the elements that are out of date
+    job_ids = copy_file(
+        source,
+        None,
+        use_slurm=True,
+        slurm_folder=tmp_path,
+        batch_param_names=["target"],
+        batch_param_list=[[middle], [tmp_path / "other.txt"]],
+    )
+    assert job_ids[0] is None
+    assert job_ids[1] is not None
+
+
+def test_profile(tmp_path, slurm_simulator):
+    for func in [cprofiled_func, tracemalloced_func]:
+        job_ids = func(
+            use_slurm=True,
+            slurm_folder=tmp_path,
+            batch_param_names=["n"],
+            batch_param_list=[[1000], [2000]],
+        )
+        slurm_simulator.run()
+        for job_id in job_ids:
+            assert slurm_simulator.job(job_id)["state"] == "COMPLETED"
+        report = slurm_helper.merge_profiles(tmp_path, func.__name__)
+        profile = "cprofile" if func is cprofiled_func else "tracemalloc"
+        assert report.startswith(f"{profile} profile merged from 2 jobs")
+        assert "test_decorators.py" in report
+
+    with pytest.raises(ValueError):
+
+        @slurm_it(conda_env="cottage_analysis", profile="unknown")
+        def unknown_profiler(n=None):
+            return n
+
+
+def test_bundle_code(tmp_path, slurm_simulator):
+    target = tmp_path / "module_file.txt"
+    job_id = bundled_func(target=str(target), use_slurm=True, slurm_folder=tmp_path)
+    (bundle,) = tmp_path.glob("code_bundle_*.zip")
+    slurm_simulator.run()
+    assert slurm_simulator.job(job_id)["state"] == "COMPLETED"
+    # the job imported this module from the bytecode in the bundle
+    assert target.read_text() == str(bundle / "tests" / "test_decorators.pyc")
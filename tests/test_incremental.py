@@ -0,0 +1,122 @@
+import os
+import subprocess
+import sys
+import threading
+from pathlib import Path
+
+import pytest
+
+from znamutils import incremental
+
+
+def test_file_signature(tmp_path):
+    path = tmp_path / "file.txt"
+    assert incremental.file_signature(path) is None
+    path.write_text("a")
+    mtime_sig = incremental.file_signature(path, method="mtime")
+    assert mtime_sig[1] == 1
+    hash_sig = incremental.file_signature(path, method="hash")
+    path.write_text("a")
+    assert incremental.file_signature(path, method="hash") == hash_sig
+    with pytest.raises(ValueError):
+        incremental.file_signature(path, method="other")
+
+
+def test_get_paths(tmp_path):
+    arguments = dict(a=tmp_path / "a", b=[str(tmp_path / "b"), tmp_path / "c"], c=None)
+    paths = incremental.get_paths(arguments, ["a", "b", "c"])
+    assert paths == [str(tmp_path / n) for n in "abc"]
+
+
+def test_record_outputs(tmp_path):
+    source, target = str(tmp_path / "source"), str(tmp_path / "target")
+    Path(source).write_text("a")
+    args = ("func", "args", [source], [target])
+    assert not incremental.is_up_to_date(*args)
+    Path(target).write_text("b")
+    incremental.record_outputs(*args)
+    assert (tmp_path / incremental.MANIFEST_NAME).exists()
+    assert incremental.is_up_to_date(*args)
+    assert not incremental.is_up_to_date("other_func", "args", [source], [target])
+    Path(source).write_text("aa")
+    assert not incremental.is_up_to_date(*args)
+
+
+def test_concurrent_records(tmp_path):
+    source = str(tmp_path / "source")
+    Path(source).write_text("a")
+    targets = [str(tmp_path / f"target_{i}") for i in range(8)]
+    for target in targets:
+        Path(target).write_text("b")
+
+    def record(target):
+        incremental.record_outputs("func", "args", [source], [target])
+
+    threads = [threading.Thread(target=record, args=(t,)) for t in targets]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for target in targets:
+        assert incremental.is_up_to_date("func", "args", [source], [target])
+    assert len(list((tmp_path / incremental.MANIFEST_NAME).iterdir())) == 8
+
+
+def test_arguments_hash():
+    np = pytest.importorskip("numpy")
+    array = np.arange(2000)
+    changed = array.copy()
+    changed[1000] = 0
+    # both arrays have the same string representation
+    assert str(array) == str(changed)
+    assert incremental.arguments_hash(dict(a=array)) != incremental.arguments_hash(
+        dict(a=changed)
+    )
+    assert incremental.arguments_hash(dict(a=array)) == incremental.arguments_hash(
+        dict(a=array.copy())
+    )
+    args = dict(a=[1, {"b": 2.0, "c": {"d", "e"}}], p=Path("/x"), o=Path)
+    same = dict(o=Path, p="/x", a=[1, {"c": {"e", "d"}, "b": 2.0}])
+    assert incremental.arguments_hash(args) == incremental.arguments_hash(same)
+    assert incremental.arguments_hash(dict(a=1)) != incremental.arguments_hash(
+        dict(a="1")
+    )
+    assert incremental.arguments_hash(
+        dict(a=1, b=2), ignore=["b"]
+    ) == incremental.arguments_hash(dict(a=1))
+    # objects that cannot be pickled are never the same
+    func = lambda x: x  # noqa: E731
+    assert incremental.arguments_hash(dict(a=func)) != incremental.arguments_hash(
+        dict(a=func)
+    )
+
+
+def test_stable_hash():
+    np = pytest.importorskip("numpy")
+    assert incremental.stable_hash(
+        [1, "a", {"b": 2, "c": 3}]
+    ) == incremental.stable_hash([1, "a", {"c": 3, "b": 2}])
+    assert incremental.stable_hash(1) != incremental.stable_hash(1.0)
+    assert incremental.stable_hash(1) != incremental.stable_hash("1")
+    assert incremental.stable_hash(Path("/a")) == incremental.stable_hash(Path("/a"))
+    array = np.arange(2000)
+    assert incremental.stable_hash(array) == incremental.stable_hash(array.copy())
+    changed = array.copy()
+    changed[1000] = 0
+    # the repr of both arrays is the same
+    assert incremental.stable_hash(array) != incremental.stable_hash(changed)
+    assert incremental.stable_hash(array) != incremental.stable_hash(
+        array.astype(np.int32)
+    )
+
+    # sets do not depend on the hash randomisation of the session
+    script = (
+        "from znamutils.incremental import stable_hash; "
+        + "print(stable_hash({'a', 'b', 'c', frozenset({'d', 'e'})}))"
+    )
+    hashes = set()
+    for seed in ["1", "2", "3"]:
+        env = dict(os.environ, PYTHONHASHSEED=seed)
+        out = subprocess.check_output([sys.executable, "-c", script], env=env)
+        hashes.add(out.decode().strip())
+    assert hashes == {incremental.stable_hash({"c", "b", "a", frozenset("ed")})}
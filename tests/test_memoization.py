@@ -0,0 +1,133 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+
+from znamutils import slurm_it
+from znamutils.memoization import Memoizer
+
+CALLS = []
+
+
+@slurm_it(conda_env="cottage_analysis", memoize=True, memoize_max_items=2)
+def memoized_func(a, b=1):
+    CALLS.append((a, b))
+    return a + b
+
+
+@slurm_it(conda_env="cottage_analysis", memoize=True)
+def memoized_job(target):
+    # the stats of the process running the function
+    with open(target, "a") as fhandle:
+        fhandle.write(f"{memoized_job.memoizer.stats['misses']}\n")
+
+
+def make_array(size, value=0):
+    CALLS.append((size, value))
+    return np.full(size, value, dtype=np.float64)
+
+
+def test_memoized_decorator():
+    CALLS.clear()
+    memoized_func.memoizer.clear()
+    memoized_func.memoizer.clear_stats()
+    assert memoized_func(1, use_slurm=False) == 2
+    assert memoized_func(1, b=1) == 2
+    assert memoized_func(a=1, b=1) == 2
+    assert CALLS == [(1, 1)]
+    memoized_func(2)
+    memoized_func(3)
+    # (1, 1) was evicted
+    memoized_func(1)
+    assert CALLS == [(1, 1), (2, 1), (3, 1), (1, 1)]
+    assert memoized_func.memoizer.stats == dict(
+        hits=2, disk_hits=0, misses=4, unhashable=0, evictions=2, disk_evictions=0
+    )
+    # arguments that cannot be pickled are not cached
+    assert memoized_func(1, b=True) == 2
+    file_handle = open(__file__)
+    with pytest.raises(TypeError):
+        memoized_func(1, b=file_handle)
+    file_handle.close()
+    assert memoized_func.memoizer.stats["unhashable"] == 1
+    assert memoized_func.memoizer.stats["misses"] == 5
+
+    with pytest.raises(ValueError):
+
+        @slurm_it(conda_env="cottage_analysis", memoize=True, outputs="b")
+        def other_func(a, b):
+            return a + b
+
+
+def test_disk_cache(tmp_path):
+    CALLS.clear()
+    # arrays of 800 bytes take 928 bytes with their header, 2 fit in the cache
+    memoizer = Memoizer(make_array, max_items=1, folder=tmp_path, max_bytes=2000)
+    out = memoizer(100)
+    assert isinstance(out, np.ndarray)
+    memoizer(100, value=1)
+    # a new session only has the disk cache
+    memoizer = Memoizer(make_array, max_items=1, folder=tmp_path, max_bytes=2000)
+    out = memoizer(100)
+    assert isinstance(out, np.memmap)
+    assert not out.flags.writeable
+    assert np.all(out == 0)
+    assert CALLS == [(100, 0), (100, 1)]
+    assert memoizer.stats["disk_hits"] == 1
+
+    # the least recently used array is evicted
+    memoizer(100, value=2)
+    assert len(list(tmp_path.glob("make_array_*.npy"))) == 2
+    assert memoizer.stats["disk_evictions"] == 1
+    memoizer = Memoizer(make_array, max_items=1, folder=tmp_path, max_bytes=2000)
+    memoizer(100)
+    memoizer(100, value=1)
+    assert CALLS == [(100, 0), (100, 1), (100, 2), (100, 1)]
+    memoizer.clear()
+    assert not list(tmp_path.iterdir())
+
+    # other results are pickled, numpy scalars included
+    memoizer = Memoizer(memoized_func.__wrapped__, folder=tmp_path)
+    assert memoizer(1, b=2) == 3
+    assert memoizer(np.float64(1), b=1) == 2
+    assert len(list(tmp_path.glob("memoized_func_*.pkl"))) == 2
+    memoizer = Memoizer(memoized_func.__wrapped__, folder=tmp_path)
+    out = memoizer(np.float64(1), b=1)
+    assert type(out) is np.float64
+    assert memoizer.stats["disk_hits"] == 1
+
+
+def test_home_folder(tmp_path, monkeypatch):
+    monkeypatch.setenv("HOME", str(tmp_path))
+    memoizer = Memoizer(make_array, folder="~/cache")
+    memoizer(10)
+    assert len(list((tmp_path / "cache").glob("make_array_*.npy"))) == 1
+
+
+def test_concurrent_writes(tmp_path):
+    memoizer = Memoizer(make_array, folder=tmp_path)
+    value = np.arange(10000)
+
+    def write(_):
+        # all threads write the same result
+        for _ in range(20):
+            memoizer._write("0" * 64, value)
+
+    with ThreadPoolExecutor(4) as pool:
+        list(pool.map(write, range(4)))
+    assert [p.name for p in tmp_path.iterdir()] == [f"make_array_{'0' * 64}.npy"]
+    assert np.all(np.load(tmp_path / f"make_array_{'0' * 64}.npy") == value)
+
+
+def test_bypassed_in_jobs(tmp_path, slurm_simulator):
+    target = tmp_path / "misses.txt"
+    memoized_job.memoizer.clear()
+    memoized_job.memoizer.clear_stats()
+    memoized_job(target, use_slurm=False)
+    memoized_job(target, use_slurm=False)
+    assert target.read_text() == "1\n"
+    # resubmitted jobs always run the function, without caching it
+    for _ in range(2):
+        memoized_job(target, use_slurm=True, slurm_folder=tmp_path)
+    slurm_simulator.run()
+    assert target.read_text() == "1\n0\n0\n"
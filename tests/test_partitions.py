@@ -0,0 +1,107 @@
+import pytest
+
+from tests.slurm_simulator import SlurmSimulator
+from znamutils import partitions, slurm_helper, slurm_it
+
+PARTITIONS = {
+    "small": dict(nodes=1, cpus=4, mem="8G", max_time="1:00:00"),
+    "big": dict(nodes=2, cpus=16, mem="128G", max_time="2-00:00:00"),
+}
+
+
+@slurm_it(
+    conda_env="cottage_analysis",
+    slurm_options={"time": "00:10:00", "mem": "1G", "partition": ["a", "b"]},
+)
+def routed_func(a=None):
+    return a
+
+
+@pytest.fixture
+def simulator(monkeypatch):
+    """In process simulator, with a new snapshot for each test"""
+
+    def get_simulator(partition_config):
+        sim = SlurmSimulator(partitions=partition_config, execute=False, runtime=600)
+        commands = []
+
+        def check_output(args, **kwargs):
+            commands.append(args[0])
+            return sim.check_output(args, **kwargs)
+
+        monkeypatch.setattr(slurm_helper.subprocess, "check_output", check_output)
+        sim.commands = commands
+        return sim
+
+    partitions.reset_snapshot()
+    yield get_simulator
+    partitions.reset_snapshot()
+
+
+def test_parsers():
+    assert partitions.parse_time("1-02:00:00") == 93600
+    assert partitions.parse_time("01:30") == 90
+    assert partitions.parse_time("UNLIMITED") is None
+    assert partitions.parse_mem("2G") == 2048
+    assert partitions.job_request({"ntasks": 2, "cpus-per-task": 3, "mem": "1G"}) == (
+        6,
+        1024,
+        None,
+    )
+
+
+def test_snapshot(simulator):
+    sim = simulator(PARTITIONS)
+    sim.check_output(["sbatch", "--wrap=true", "-p", "small", "-c", "4", "-t", "10"])
+    sim.check_output(["sbatch", "--wrap=true", "-p", "small", "-c", "2", "-t", "10"])
+    sim.advance(60)
+    snapshot = partitions.get_snapshot()
+    small = snapshot["small"]
+    assert small["max_time"] == 3600
+    assert small["nodes"] == [dict(cpus=4, mem=8192, free_cpus=0, free_mem=7168)]
+    assert small["pending"] == 2 * 600
+    assert small["running"] == 4 * 540
+    assert len(snapshot["big"]["nodes"]) == 2
+    assert snapshot["big"]["pending"] == 0
+
+    # the snapshot is cached
+    assert partitions.get_snapshot() is snapshot
+    assert sim.commands == ["sinfo", "squeue"]
+    assert partitions.get_snapshot(ttl=0) is not snapshot
+    assert len(sim.commands) == 4
+
+
+def test_select_partition(simulator):
+    sim = simulator(PARTITIONS)
+    options = {"time": "00:10:00", "mem": "1G"}
+    assert partitions.select_partition(["small", "big"], options) == "small"
+    # too long or too large for the small partition
+    options = {"time": "02:00:00", "mem": "1G"}
+    assert partitions.select_partition(["small", "big"], options) == "big"
+    options = {"time": "00:10:00", "mem": "16G"}
+    assert partitions.select_partition(["small", "big"], options) == "big"
+    with pytest.raises(ValueError):
+        partitions.select_partition(["small"], options)
+    # the small partition is full
+    sim.check_output(["sbatch", "--wrap=true", "-p", "small", "-c", "4"])
+    sim.advance(1)
+    partitions.reset_snapshot()
+    options = {"time": "00:10:00", "mem": "1G"}
+    assert partitions.select_partition(["small", "big"], options) == "big"
+
+
+def test_routing(tmp_path, simulator):
+    config = dict(nodes=1, cpus=4, mem="8G", max_time="1:00:00")
+    sim = simulator({"a": config, "b": config})
+    job_ids = routed_func(
+        use_slurm=True,
+        slurm_folder=tmp_path,
+        batch_param_list=[[i] for i in range(10)],
+        batch_param_names=["a"],
+    )
+    # a single snapshot for the whole batch
+    assert sim.commands.count("sinfo") == 1
+    routed = [sim.job(job_id)["partition"] for job_id in job_ids]
+    assert routed == ["a"] * 4 + ["b"] * 4 + ["a", "b"]
+    sim.run()
+    assert max(sim.queue_wait_times().values()) == 600
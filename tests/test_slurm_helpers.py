@@ -1,14 +1,11 @@
+import zipfile
 from pathlib import Path
 
 import numpy as np
+import pytest
 
 from znamutils import slurm_helper
 
-try:
-    import flexiznam as flz
-except ImportError:
-    raise ImportError("flexiznam is required to run this test")
-
 
 def test_create_slurm_sbatch(tmpdir):
     slurm_helper.create_slurm_sbatch(
@@ -28,8 +25,7 @@ def test_create_slurm_sbatch(tmpdir):
         "#SBATCH --partition=ncpu",
         f"#SBATCH --output={tmpdir}/test.out",
         'echo "Job ID: $SLURM_JOB_ID"',
-        "ml Anaconda3",
-        "source activate base",
+        "source ~/.bashrc ",
         "conda activate cottage_analysis",
         "export LD_LIBRARY_PATH=$LD_LIBRARY_PATH:~/.conda/envs/cottage_analysis/lib/",
         "",
@@ -220,8 +216,239 @@ def test_run_slurm_batch():
     assert cmd == f"sbatch --export=var=value --dependency=afterok:12 {script_path}"
 
 
+def test_collapse_job_ids():
+    # all tasks of array 12 (tasks 1 to 5) are listed
+    job_ids = ["12_1", "12_2", "13", 14, "12_[3-5]", "13"]
+    assert slurm_helper.collapse_job_ids(job_ids) == ["12", "13", "14"]
+
+
+def test_submit_barrier_job():
+    cmd = slurm_helper.submit_barrier_job(["1", "2"], dry_run=True)
+    assert cmd.startswith("sbatch --job-name=barrier --partition=ncpu ")
+    assert "--kill-on-invalid-dep=yes" in cmd
+    assert cmd.endswith("--dependency=afterok:1:2 --wrap=true")
+    cmd = slurm_helper.submit_barrier_job(
+        ["1"], slurm_options={"partition": "cpu"}, dry_run=True
+    )
+    assert "--partition=cpu" in cmd
+    with pytest.raises(ValueError):
+        slurm_helper.submit_barrier_job(["1"], dependency_type="aftercorr")
+
+
+def test_reduce_job_dependency():
+    dep, dep_type = slurm_helper.reduce_job_dependency([])
+    assert dep is None
+    # array members are kept by default, a single task is not the whole array
+    dep, dep_type = slurm_helper.reduce_job_dependency(["123_4"], "afternotok")
+    assert dep == "123_4"
+    assert dep_type == "afternotok"
+    dep, dep_type = slurm_helper.reduce_job_dependency(
+        ["1_1", "1_2", "2"], dependency_type="afterany", collapse_arrays=True
+    )
+    assert dep == "1:2"
+    assert dep_type == "afterany"
+
+
+def test_python_script_single_func_profile(tmpdir):
+    target_file = tmpdir / "test.py"
+    slurm_helper.python_script_single_func(
+        target_file,
+        function_name="test",
+        arguments=dict(arg1=1),
+        profile="cprofile",
+        profile_prefix="/prof/test",
+    )
+    with open(target_file) as f:
+        txt = f.read()
+    lines = [
+        "",
+        "import os",
+        "import cProfile",
+        "",
+        "_profiler = cProfile.Profile()",
+        "_profiler.enable()",
+        "try:",
+        "    _output = test(arg1=1, )",
+        "finally:",
+        "    _profiler.disable()",
+        "    _profiler.dump_stats('/prof/test_' + "
+        + "os.environ.get('SLURM_JOB_ID', 'local') + '.prof')",
+        "",
+    ]
+    assert txt.split("\n") == lines
+    with pytest.raises(ValueError):
+        slurm_helper.python_script_single_func(
+            target_file, function_name="test", profile="unknown", profile_prefix="a"
+        )
+
+
+def test_merge_profiles(tmpdir, monkeypatch):
+    import cProfile
+
+    for job_id in range(3):
+        profiler = cProfile.Profile()
+        profiler.enable()
+        sum(range(1000))
+        profiler.disable()
+        profiler.dump_stats(str(tmpdir / f"test_{job_id}.prof"))
+    # profile of another script in the same folder
+    profiler.dump_stats(str(tmpdir / "test_other_2.prof"))
+    report = slurm_helper.merge_profiles(
+        tmpdir, "test", target_file=tmpdir / "report.txt"
+    )
+    assert report.startswith("cprofile profile merged from 3 jobs")
+    assert (tmpdir / "report.txt").read_text("utf-8") == report
+    with pytest.raises(FileNotFoundError):
+        slurm_helper.merge_profiles(tmpdir, "other")
+    monkeypatch.setenv("HOME", str(tmpdir))
+    assert slurm_helper.merge_profiles("~", "test", target_file="~/home.txt") == report
+    assert (tmpdir / "home.txt").read_text("utf-8") == report
+
+
+def test_merge_pyinstrument_profiles(tmpdir):
+    pytest.importorskip("pyinstrument")
+    from pyinstrument import Profiler
+
+    for job_id in ["1", "local"]:
+        profiler = Profiler()
+        profiler.start()
+        sum(range(1000))
+        profiler.stop()
+        profiler.last_session.save(str(tmpdir / f"test_{job_id}.pyisession"))
+    report = slurm_helper.merge_profiles(tmpdir, "test")
+    assert report.startswith("pyinstrument profile merged from 2 jobs")
+
+
+def test_bundle_modules(tmpdir, monkeypatch):
+    src = Path(tmpdir) / "src"
+    (src / "bundled_pkg").mkdir(parents=True)
+    (src / "bundled_pkg" / "__init__.py").write_text("VALUE = 1\n")
+    monkeypatch.syspath_prepend(str(src))
+    bundle = slurm_helper.bundle_modules(["bundled_pkg", "os", "__main__"], tmpdir)
+    assert bundle.name.startswith("code_bundle_")
+    with zipfile.ZipFile(bundle) as zfile:
+        names = zfile.namelist()
+    assert names == ["bundled_pkg/__init__.py", "bundled_pkg/__init__.pyc"]
+    # same source, same bundle
+    assert slurm_helper.bundle_modules(["bundled_pkg.sub"], tmpdir) == bundle
+    # new source, new bundle
+    (src / "bundled_pkg" / "__init__.py").write_text("VALUE = 2\n")
+    assert slurm_helper.bundle_modules(["bundled_pkg"], tmpdir) != bundle
+    assert slurm_helper.bundle_modules(["os"], tmpdir) is None
+
+    # data files are bundled, files that do not compile are bundled without bytecode
+    (src / "bundled_pkg" / "data.json").write_text("{}")
+    (src / "bundled_pkg" / "broken.py").write_text("def broken(:\n")
+    (src / "bundled_pkg" / "__pycache__").mkdir(exist_ok=True)
+    (src / "bundled_pkg" / "__pycache__" / "x.pyc").write_bytes(b"")
+    other = slurm_helper.bundle_modules(["bundled_pkg"], tmpdir)
+    with zipfile.ZipFile(other) as zfile:
+        names = zfile.namelist()
+    assert names == [
+        "bundled_pkg/__init__.py",
+        "bundled_pkg/__init__.pyc",
+        "bundled_pkg/broken.py",
+        "bundled_pkg/data.json",
+    ]
+    # no temporary file is left on failure
+    (src / "bundled_pkg" / "data.json").write_text("[]")
+
+    def fail(*args):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(slurm_helper, "_add_to_bundle", fail)
+    with pytest.raises(OSError):
+        slurm_helper.bundle_modules(["bundled_pkg"], tmpdir)
+    assert not list(Path(tmpdir).glob("*.tmp"))
+
+    target_file = tmpdir / "test.py"
+    slurm_helper.python_script_single_func(
+        target_file,
+        function_name="test",
+        from_imports={"bundled_pkg": "VALUE"},
+        sys_path=[bundle],
+    )
+    with open(target_file) as f:
+        txt = f.read()
+    assert txt.startswith(f"import sys\n\nsys.path.insert(0, {repr(str(bundle))})\n")
+
+
+def test_script_template(tmpdir, monkeypatch):
+    source = tmpdir / "template.py"
+    source.write_text(
+        'a = "XXX_A_XXX"\nb = "XXX_LONG_NAME_XXX"\nc = "XXX_A_XXX"\n', "utf-8"
+    )
+    template = slurm_helper.ScriptTemplate(source)
+    assert template.placeholders == {"A", "LONG_NAME"}
+    txt = template.render(dict(a=1, long_name="XXX_A_XXX"))
+    assert txt == "a = 1\nb = 'XXX_A_XXX'\nc = 1\n"
+    with pytest.raises(ValueError):
+        template.render(dict(a=1))
+    assert template.render(dict(a=1), strict=False).startswith('a = 1\nb = "XXX_')
+
+    scripts = template.write_many(
+        tmpdir, [dict(a=i, long_name=str(i)) for i in range(3)]
+    )
+    assert [s.name for s in scripts] == [f"template_{i}.py" for i in range(3)]
+    assert scripts[2].read_text() == "a = 2\nb = '2'\nc = 2\n"
+
+    slurm_helper.python_script_from_template(
+        tmpdir, source, target_script_name="single.py", arguments=dict(a=[1])
+    )
+    txt = (tmpdir / "single.py").read_text("utf-8")
+    assert txt == 'a = [1]\nb = "XXX_LONG_NAME_XXX"\nc = [1]\n'
+    # any key accepted by the previous str.replace implementation
+    source.write_text('a = "XXX_MY-ARG.2_XXX"\n', "utf-8")
+    slurm_helper.python_script_from_template(
+        tmpdir, source, target_script_name="single.py", arguments={"my-arg.2": 1}
+    )
+    assert (tmpdir / "single.py").read_text("utf-8") == "a = 1\n"
+    # lower case placeholders are filled, or left as written
+    source.write_text('a = "XXX_name_XXX"\n', "utf-8")
+    template = slurm_helper.ScriptTemplate(source)
+    assert template.placeholders == {"NAME"}
+    assert template.render(dict(name=1)) == "a = 1\n"
+    assert template.render(strict=False) == 'a = "XXX_name_XXX"\n'
+
+    monkeypatch.setenv("HOME", str(tmpdir))
+    (script,) = template.write_many("~", [dict(NAME=2)])
+    assert script == tmpdir / "template_0.py"
+    assert script.read_text() == "a = 2\n"
+
+
+def test_hashed_files(tmp_path):
+    first = slurm_helper.write_hashed_file(tmp_path, "script", ".py", "a = 1\n")
+    assert first.name.startswith("script_") and first.suffix == ".py"
+    mtime = first.stat().st_mtime_ns
+    # same content, same file, not rewritten
+    assert slurm_helper.write_hashed_file(tmp_path, "script", ".py", "a = 1\n") == first
+    assert first.stat().st_mtime_ns == mtime
+    second = slurm_helper.write_hashed_file(tmp_path, "script", ".py", "a = 2\n")
+    assert second != first
+    assert first.read_text() == "a = 1\n"
+    assert sorted(tmp_path.iterdir()) == sorted([first, second])
+
+    payload = slurm_helper.write_arguments_payload(
+        tmp_path, "script", dict(a=1, path=tmp_path, text="b")
+    )
+    assert payload.name.startswith("script_args_")
+    namespace = {}
+    exec(payload.read_text(), namespace)
+    assert namespace["arguments"] == dict(a=1, path=str(tmp_path), text="b")
+
+    sbatch = slurm_helper.create_slurm_sbatch(
+        tmp_path, "job", "script.py", "env", pass_arguments=True, content_hash=True
+    )
+    txt = sbatch.read_text()
+    assert sbatch.name.startswith("job_")
+    assert "#SBATCH --job-name=job\n" in txt
+    assert txt.endswith('python script.py "$@"\n')
+
+
 if __name__ == "__main__":
-    tmpdir = Path(flz.PARAMETERS["data_root"]["processed"]) / "test"
+    import tempfile
+
+    tmpdir = Path(tempfile.mkdtemp())
     test_run_slurm_batch()
     test_python_script_single_func(tmpdir)
     test_create_slurm_sbatch(tmpdir)
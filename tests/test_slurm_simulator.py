@@ -0,0 +1,125 @@
+import time
+
+import pytest
+
+from tests.slurm_simulator import SlurmSimulator, parse_array, parse_time
+from znamutils import slurm_helper, slurm_it
+
+
+@slurm_it(conda_env="cottage_analysis", slurm_options={"time": "00:10:00", "mem": "1G"})
+def scaling_func(a=None):
+    return a
+
+
+def test_parsers():
+    assert parse_time("10") == 600
+    assert parse_time("01:30") == 90
+    assert parse_time("1-02:00:00") == 93600
+    assert parse_time("infinite") is None
+    assert parse_array("0-3") == [0, 1, 2, 3]
+    assert parse_array("1,5-9:2%2") == [1, 5, 7, 9]
+
+
+def test_scheduling():
+    sim = SlurmSimulator(
+        partitions={"cpu": dict(nodes=1, cpus=2, mem="4G", max_time="1:00:00")},
+        execute=False,
+        runtime=100,
+    )
+    first = sim.check_output(["sbatch", "--wrap=true", "-c", "2"]).decode()
+    first = first.split()[-1]
+    array = sim.check_output(["sbatch", "--parsable", "--wrap=true", "--array=0-3"])
+    array = array.decode().strip()
+    corr = sim.check_output(
+        [
+            "sbatch",
+            "--parsable",
+            "--wrap=true",
+            "--array=0-3",
+            "--time=00:01:00",
+            f"--dependency=aftercorr:{array}",
+        ]
+    ).decode()
+    corr = corr.strip()
+    squeue = sim.check_output(["squeue", "-h", "-o", "%i %t"]).decode()
+    assert squeue.split("\n")[0] == f"{first} PD"
+    sim.advance(10)
+    assert sim.job(first)["state"] == "RUNNING"
+    sim.run()
+    # the array tasks run 2 by 2 once the first job is done
+    assert sim.job(f"{array}_1")["start_time"] == 100
+    assert sim.job(f"{array}_3")["start_time"] == 200
+    # and time out after 1 minute
+    assert sim.job(f"{corr}_0")["state"] == "TIMEOUT"
+    assert sim.job(f"{corr}_0")["end_time"] - sim.job(f"{corr}_0")["start_time"] == 60
+    sacct = sim.check_output(
+        ["sacct", "-j", array, "--format=JobID,State,Start", "-P", "-n"]
+    ).decode()
+    assert sacct.split("\n")[0] == f"{array}_0|COMPLETED|2024-01-01T00:01:40"
+
+
+def test_dependencies_and_failures(tmp_path):
+    sim = SlurmSimulator(runtime=10)
+
+    def sbatch(*args):
+        cmd = ["sbatch", "--parsable", f"--chdir={tmp_path}"] + list(args)
+        return sim.check_output(cmd).decode().strip()
+
+    failed = sbatch("--wrap=false")
+    never = sbatch("--wrap=true", f"--dependency=afterok:{failed}")
+    killed = sbatch(
+        "--wrap=true", "--kill-on-invalid-dep=yes", f"--dependency=afterok:{failed}"
+    )
+    rescue = sbatch("--wrap=true", f"--dependency=afternotok:{failed}")
+    sim.run()
+    assert sim.job(failed)["state"] == "FAILED"
+    assert sim.job(failed)["exit_code"] == "1:0"
+    assert sim.job(never)["reason"] == "DependencyNeverSatisfied"
+    assert sim.job(killed)["state"] == "CANCELLED"
+    assert sim.job(rescue)["state"] == "COMPLETED"
+    sim.check_output(["scancel", never])
+    assert sim.job(never)["state"] == "CANCELLED"
+    out, err, returncode = sim.run_command(
+        ["sbatch", "--wrap=true", "-d", "afterok:99"]
+    )
+    assert returncode == 1
+    assert "Job dependency problem" in err
+
+    sim = SlurmSimulator(execute=False, failure_rate=1)
+    failed = sim.check_output(["sbatch", "--parsable", "--wrap=true"]).decode().strip()
+    sim.run()
+    assert sim.job(failed)["state"] == "FAILED"
+
+
+def test_command_line(tmp_path, slurm_simulator):
+    script = tmp_path / "job.sh"
+    script.write_text(
+        "#!/bin/bash\n#SBATCH --job-name=cli_test\n"
+        + f"#SBATCH --output={tmp_path}/%x_%j.out\n"
+        + "echo $SLURM_JOB_ID\n"
+    )
+    out = slurm_helper.run_slurm_batch(str(script))
+    assert out == "1"
+    slurm_simulator.run()
+    assert (tmp_path / "cli_test_1.out").read_text().strip() == "1"
+
+
+def test_scaling(tmp_path, monkeypatch):
+    """Submit 10,000 jobs with slurm_it and check the simulated queue wait time"""
+    n_jobs = 10000
+    sim = SlurmSimulator(execute=False, runtime=60)
+    monkeypatch.setattr(slurm_helper.subprocess, "check_output", sim.check_output)
+    start = time.time()
+    job_ids = scaling_func(
+        use_slurm=True,
+        slurm_folder=tmp_path,
+        batch_param_list=[[i] for i in range(n_jobs)],
+        batch_param_names=["a"],
+    )
+    submission_time = time.time() - start
+    assert len(job_ids) == n_jobs
+    sim.run()
+    waits = sim.queue_wait_times()
+    # 4 nodes of 8 cpus run 32 jobs of 60s at a time
+    assert max(waits.values()) == pytest.approx(60 * (n_jobs // 32))
+    assert submission_time < 60
@@ -0,0 +1,62 @@
+import json
+
+import pytest
+
+from tests.test_decorators import batch_test_func
+from znamutils import slurm_helper
+from znamutils.telemetry import TELEMETRY
+
+
+@pytest.fixture
+def telemetry():
+    TELEMETRY.reset()
+    yield TELEMETRY
+    TELEMETRY.callbacks = []
+    TELEMETRY.reset()
+
+
+def test_telemetry(tmp_path, slurm_simulator, telemetry, monkeypatch):
+    events = []
+    telemetry.add_callback(events.append)
+    job_ids = batch_test_func(
+        str(tmp_path),
+        use_slurm=True,
+        slurm_folder=tmp_path,
+        batch_param_names=["a"],
+        batch_param_list=[[1], [2]],
+    )
+    with pytest.raises(Exception):
+        slurm_helper.run_slurm_batch(tmp_path / "missing.sh")
+    assert len(events) == 3
+    assert events[0]["label"] == "batch_test_func"
+    assert events[0]["job_id"] == job_ids[0]
+    assert events[-1]["error"] is not None
+
+    slurm_simulator.run()
+    telemetry.update_jobs()
+    assert len(events) == 5
+    assert events[-1]["type"] == "job"
+    assert events[-1]["state"] == "COMPLETED"
+    assert events[-1]["queue_wait"] == 0
+    summary = telemetry.summary()
+    assert summary["batch_test_func"]["submissions"] == 2
+    assert summary["batch_test_func"]["states"] == {"COMPLETED": 2}
+    assert summary["missing"]["errors"] == 1
+
+    txt = telemetry.to_openmetrics(tmp_path / "metrics.prom")
+    assert (tmp_path / "metrics.prom").read_text() == txt
+    assert 'znamutils_submissions_total{function="batch_test_func"} 2' in txt
+    assert 'znamutils_jobs_total{function="batch_test_func",state="COMPLETED"} 2' in txt
+    assert 'znamutils_queue_wait_seconds_count{function="batch_test_func"} 2' in txt
+    assert txt.endswith("# EOF\n")
+
+    # paths starting with ~ are in the home directory
+    monkeypatch.setenv("HOME", str(tmp_path))
+    telemetry.to_openmetrics("~/home_metrics.prom")
+    assert (tmp_path / "home_metrics.prom").read_text() == txt
+    telemetry.to_json("~/events.jsonl")
+    telemetry.to_json(tmp_path / "events.jsonl")
+    lines = (tmp_path / "events.jsonl").read_text().splitlines()
+    assert [json.loads(line)["type"] for line in lines] == ["submission"] * 3 + [
+        "job"
+    ] * 2
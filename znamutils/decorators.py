@@ -1,10 +1,15 @@
+import os
+from importlib.util import find_spec
 from inspect import Parameter, signature
 from pathlib import Path
 
 from decopatch import DECORATED, function_decorator
 from makefun import add_signature_parameters, wraps
 
-from znamutils import slurm_helper
+from znamutils import incremental, memoization, partitions, slurm_helper
+
+# set in the environment of the jobs submitted by slurm_it
+JOB_ENV_VAR = "ZNAMUTILS_SLURM_JOB"
 
 
 @function_decorator
@@ -16,6 +21,17 @@ def slurm_it(
     imports=None,
     from_imports=None,
     print_job_id=False,
+    max_dependencies=500,
+    collapse_arrays=False,
+    profile=None,
+    bundle_code=False,
+    inputs=None,
+    outputs=None,
+    file_check="mtime",
+    memoize=False,
+    memoize_folder=None,
+    memoize_max_items=128,
+    memoize_max_bytes=2**30,
 ):
     """
     Decorator to run a function on slurm.
@@ -31,9 +47,15 @@ def slurm_it(
             Defaults to "afterok" which only runs the next job if all previous
             jobs have finished successfully. Other options are "after", "afterany",
             "aftercorr" and "afternotok". See sbatch documentation for more details.
-        job_dependency (str): job id to depend on
+            With batch jobs, "aftercorr" and a list of job_dependency of the same
+            length as batch_param_list makes each job depend on the corresponding
+            job of the list.
+        job_dependency (str or list): job id(s) to depend on. Long lists are reduced
+            with barrier jobs (see `max_dependencies` and `collapse_arrays`).
         slurm_folder (str): where to write the slurm script and logs
-        scripts_name (str): name of the slurm script and python file
+        scripts_name (str): prefix of the name of the slurm script, python file,
+            arguments payload and logs. Scripts are named after their content and
+            reused by all calls with the same script.
         slurm_options (dict): options to pass to sbatch
 
     The default slurm options are:
@@ -47,7 +69,11 @@ def slurm_it(
         conda_env (str): name of the conda environment to activate. Required.
         module_list (list, optional): list of modules to load with ml. Defaults to None.
         slurm_options (dict, optional): options to pass to sbatch. Will be used to
-            update the default config (see above) if not None. Defaults to None.
+            update the default config (see above) if not None. The partition can be a
+            list of candidate partitions: each job is then submitted to the partition
+            where it is expected to start first, given its cpus, mem and time and a
+            cached snapshot of the cluster load (see `znamutils.partitions`). Defaults
+            to None.
         imports (str or list, optional): List of imports to add to the script. Defaults
             to None.
         from_imports (dict, optional): Dictionary of imports to add to the python
@@ -57,6 +83,46 @@ def slurm_it(
             None.
         print_job_id (bool, optional): Whether to print the job id of the slurm job in
             the log file. Defaults to False.
+        max_dependencies (int, optional): Maximum number of job ids in a single
+            dependency. Longer lists of dependencies are replaced by a hierarchy of
+            lightweight barrier jobs. Defaults to 500.
+        collapse_arrays (bool, optional): Whether to replace job array members in
+            job_dependency lists by their array job. This makes the job depend on all
+            tasks of the arrays, so it should only be used when the lists contain
+            complete arrays. Defaults to False.
+        profile (str, optional): Profile the function when running on slurm. One of
+            "cprofile", "tracemalloc" or "pyinstrument" (if installed). The profile of
+            each job is written in slurm_folder as `<scripts_name>_<job_id>.<ext>`. Use
+            `slurm_helper.merge_profiles` to combine them. Defaults to None.
+        bundle_code (bool, optional): Whether to bundle the source of the modules in
+            `imports` and `from_imports` in a zip file in slurm_folder when submitting.
+            The jobs then import the code from this single file, which does not change
+            if the source is edited while jobs are queued. Installed packages are not
+            bundled. Defaults to False.
+        inputs (str or list, optional): Names of the arguments that are input files
+            (or lists of files) of the function. Defaults to None.
+        outputs (str or list, optional): Names of the arguments that are output files
+            (or lists of files) of the function. If provided, calls whose outputs are
+            up to date with their inputs, the function source and the other arguments
+            are skipped: the function is not run and returns None, or the job is not
+            submitted and None is returned instead of its job id. Calls depending on a
+            submitted job are always submitted. Defaults to None.
+        file_check (str, optional): How to know if files changed, "mtime" to compare
+            modification times and sizes or "hash" to compare content. Defaults to
+            "mtime".
+        memoize (bool, optional): Whether to cache the results of calls with
+            use_slurm=False. Calls with the same arguments and function source return
+            the cached result without running the function. The cache statistics are
+            in `<decorated function>.memoizer.stats`. Cannot be used with `outputs`.
+            The cache is bypassed in jobs submitted by slurm_it, so that resubmitted
+            jobs always run the function. Defaults to False.
+        memoize_folder (str, optional): Folder of the on-disk cache. Numpy arrays are
+            saved as `.npy` and memory-mapped when loaded, other results are pickled.
+            If None, results are only cached in memory. Defaults to None.
+        memoize_max_items (int, optional): Maximum number of results cached in memory.
+            Defaults to 128.
+        memoize_max_bytes (int, optional): Maximum size of the on-disk cache in bytes.
+            Defaults to 1GB.
 
     Returns:
         function: decorated function
@@ -87,6 +153,51 @@ def slurm_it(
         last=parameters,
     )
     from_imports = from_imports or {func.__module__: func.__name__}
+    if isinstance(inputs, str):
+        inputs = [inputs]
+    if isinstance(outputs, str):
+        outputs = [outputs]
+    if file_check not in incremental.METHODS:
+        raise ValueError(
+            f"Unknown file_check {file_check}. Must be one of {incremental.METHODS}"
+        )
+    for name in (inputs or []) + (outputs or []):
+        if name not in func_sig.parameters:
+            raise ValueError(f"{name} is not an argument of {func.__name__}")
+    if outputs is not None:
+        func_hash = incremental.source_hash(func)
+    memoizer = None
+    if memoize:
+        if outputs is not None:
+            raise ValueError("memoize cannot be used with outputs")
+        memoizer = memoization.Memoizer(
+            func,
+            max_items=memoize_max_items,
+            folder=memoize_folder,
+            max_bytes=memoize_max_bytes,
+        )
+    if profile is not None:
+        if profile not in slurm_helper.PROFILERS:
+            raise ValueError(
+                f"Unknown profiler {profile}. "
+                + f"Must be one of {list(slurm_helper.PROFILERS)}"
+            )
+        if profile == "pyinstrument" and find_spec("pyinstrument") is None:
+            raise ImportError("pyinstrument is required to profile with pyinstrument")
+
+    def tracked_files(args, kwargs):
+        """Paths and hashes describing the files of a call, see `incremental`"""
+        bound = func_sig.bind(*args, **kwargs)
+        bound.apply_defaults()
+        return dict(
+            func_hash=func_hash,
+            args_hash=incremental.arguments_hash(
+                bound.arguments, ignore=(inputs or []) + outputs
+            ),
+            inputs=incremental.get_paths(bound.arguments, inputs or []),
+            outputs=incremental.get_paths(bound.arguments, outputs),
+            method=file_check,
+        )
 
     # create the new function with modified signature
     @wraps(func, new_sig=new_sig)
@@ -106,12 +217,22 @@ def slurm_it(
         slurm_options = dict(default_slurm_options, **slurm_options)
 
         if isinstance(job_dependency, list) or isinstance(job_dependency, tuple):
-            job_dependency = ":".join(job_dependency) if len(job_dependency) else None
+            job_dependency = list(job_dependency) if len(job_dependency) else None
 
         if not use_slurm:
             if job_dependency is not None:
                 raise ValueError("job_dependency should be None if use_slurm is False")
-            return func(*args, **kwargs)
+            if memoizer is not None and not os.environ.get(JOB_ENV_VAR):
+                return memoizer(*args, **kwargs)
+            if outputs is None:
+                return func(*args, **kwargs)
+            files = tracked_files(args, kwargs)
+            if incremental.is_up_to_date(**files):
+                print(f"{func.__name__}: outputs are up to date, skipping")
+                return None
+            out = func(*args, **kwargs)
+            incremental.record_outputs(**files)
+            return out
 
         if slurm_folder is None:
             raise ValueError("slurm_folder should be provided if use_slurm is True")
@@ -121,10 +242,20 @@ def slurm_it(
             scripts_name = func.__name__
         slurm_folder = Path(slurm_folder)
         assert slurm_folder.exists(), f"Folder {slurm_folder} does not exist"
-        python_file = slurm_folder / f"{scripts_name}.py"
-        sbatch_file = slurm_folder / f"{scripts_name}.sh"
         assert conda_env is not None, "conda_env should be provided in the decorator"
 
+        # a list of partitions is resolved job by job at submission
+        candidate_partitions = None
+        if isinstance(slurm_options.get("partition"), (list, tuple)):
+            candidate_partitions = list(slurm_options["partition"])
+            slurm_options["partition"] = ",".join(candidate_partitions)
+            job_request = dict(slurm_helper.DEFAULT_SLURM_OPTIONS, **slurm_options)
+
+        def choose_partition():
+            if candidate_partitions is None:
+                return None
+            return partitions.select_partition(candidate_partitions, job_request)
+
         if batch_param_names is not None:
             if isinstance(batch_param_names, str):
                 batch_param_names = [batch_param_names]
@@ -138,16 +269,57 @@ def slurm_it(
             env_vars_to_pass = {p: p for p in batch_param_names}
         else:
             env_vars_to_pass = None
-        slurm_helper.create_slurm_sbatch(
-            target_folder=slurm_folder,
-            script_name=sbatch_file.name,
-            python_script=str(python_file),
-            conda_env=conda_env,
-            slurm_options=slurm_options,
-            module_list=module_list,
-            print_job_id=print_job_id,
-            env_vars_to_pass=env_vars_to_pass,
-        )
+
+        if dependency_type is None:
+            dependency_type = "afterok"
+        # one dependency per job of the batch for aftercorr, shared otherwise
+        batch_dependencies = None
+        if isinstance(job_dependency, list):
+            if dependency_type == "aftercorr" and env_vars_to_pass is not None:
+                assert len(job_dependency) == len(
+                    batch_param_list
+                ), "aftercorr requires one job_dependency per element of the batch"
+                batch_dependencies = job_dependency
+                dependency_type = "afterok"
+            else:
+                # skipped upstream calls return None instead of a job id
+                job_dependency = [j for j in job_dependency if j is not None] or None
+
+        # skip the calls with up to date outputs and no submitted dependency
+        to_submit = None
+        if outputs is not None:
+            # jobs get numpy objects as python objects (see python_script_single_func)
+            job_kwargs = {
+                k: v.tolist() if type(v).__module__ == "numpy" else v
+                for k, v in kwargs.items()
+            }
+            if env_vars_to_pass is None:
+                if job_dependency is None and incremental.is_up_to_date(
+                    **tracked_files(args, job_kwargs)
+                ):
+                    print(f"{func.__name__}: outputs are up to date, skipping")
+                    return None
+            else:
+                to_submit = []
+                for i_job, params in enumerate(batch_param_list):
+                    if batch_dependencies is not None:
+                        dependency = batch_dependencies[i_job]
+                    else:
+                        dependency = job_dependency
+                    # the job gets the batch parameters as strings from argparse
+                    batch_kwargs = dict(
+                        job_kwargs,
+                        **{n: str(p) for n, p in zip(batch_param_names, params)},
+                    )
+                    to_submit.append(
+                        dependency is not None
+                        or not incremental.is_up_to_date(
+                            **tracked_files(args, batch_kwargs)
+                        )
+                    )
+                if not any(to_submit):
+                    print(f"{func.__name__}: outputs are up to date, skipping")
+                    return [None] * len(batch_param_list)
 
         # make sure that the function does not use slurm once running on slurm
         kwargs["use_slurm"] = False
@@ -159,28 +331,84 @@ def slurm_it(
                     print(f"Warning: parameter {p_name}={v} was removed from kwargs")
                     print("It will be passed as environment variable")
 
-        slurm_helper.python_script_single_func(
-            target_file=python_file,
+        sys_path = None
+        if bundle_code:
+            if imports is None:
+                modules = []
+            elif isinstance(imports, str):
+                modules = [imports.split(" ")[0]]
+            else:
+                modules = [imp.split(" ")[0] for imp in imports]
+            modules.extend(from_imports.keys())
+            bundle = slurm_helper.bundle_modules(modules, target_folder=slurm_folder)
+            if bundle is not None:
+                sys_path = [bundle]
+
+        # the scripts are named after their content and the arguments of the call are
+        # in a separate payload, so that concurrent calls never overwrite each other
+        python_file = slurm_helper.python_script_single_func(
+            target_file=slurm_folder / f"{scripts_name}.py",
             function_name=func.__name__,
-            arguments=kwargs,
             imports=imports,
             from_imports=from_imports,
             vars2parse=env_vars_to_pass,
+            profile=profile,
+            profile_prefix=slurm_folder / scripts_name,
+            sys_path=sys_path,
+            payload=True,
+            content_hash=True,
+        )
+        sbatch_file = slurm_helper.create_slurm_sbatch(
+            target_folder=slurm_folder,
+            script_name=f"{scripts_name}.sh",
+            python_script=str(python_file),
+            conda_env=conda_env,
+            slurm_options=slurm_options,
+            module_list=module_list,
+            print_job_id=print_job_id,
+            add_jobid_to_output=True,
+            env_vars_to_pass=env_vars_to_pass,
+            pass_arguments=True,
+            content_hash=True,
+            export_vars={JOB_ENV_VAR: 1},
         )
+        payload = slurm_helper.write_arguments_payload(
+            slurm_folder, scripts_name, kwargs
+        )
+        script_args = ["--payload", str(payload)]
 
-        if dependency_type is None:
-            dependency_type = "afterok"
+        if isinstance(job_dependency, list):
+            barrier_options = {
+                "partition": slurm_options.get(
+                    "partition", slurm_helper.DEFAULT_SLURM_OPTIONS["partition"]
+                )
+            }
+            job_dependency, dependency_type = slurm_helper.reduce_job_dependency(
+                job_dependency,
+                dependency_type=dependency_type,
+                max_dependencies=max_dependencies,
+                collapse_arrays=collapse_arrays,
+                barrier_options=barrier_options,
+            )
 
         if env_vars_to_pass is not None:
             # run multiple jobs
             job_ids = []
-            for params in batch_param_list:
+            for i_job, params in enumerate(batch_param_list):
+                if to_submit is not None and not to_submit[i_job]:
+                    job_ids.append(None)
+                    continue
                 env_vars = {k: v for k, v in zip(batch_param_names, params)}
+                if batch_dependencies is not None:
+                    job_dependency = batch_dependencies[i_job]
                 jid = slurm_helper.run_slurm_batch(
                     sbatch_file,
                     dependency_type=dependency_type,
                     job_dependency=job_dependency,
                     env_vars=env_vars,
+                    label=func.__name__,
+                    script_args=script_args,
+                    partition=choose_partition(),
                 )
                 job_ids.append(jid)
             return job_ids
@@ -189,7 +417,11 @@ def slurm_it(
             sbatch_file,
             dependency_type=dependency_type,
             job_dependency=job_dependency,
+            label=func.__name__,
+            script_args=script_args,
+            partition=choose_partition(),
         )
 
+    new_func.memoizer = memoizer
     # return the new function
     return new_func
@@ -0,0 +1,240 @@
+"""Make-style tracking of the input and output files of a function
+
+For each output file, a record in the manifest folder next to it stores the signature
+of the inputs and outputs, the source of the function and its other arguments when the
+output was last produced. An output is up to date if none of these changed since.
+"""
+import hashlib
+import inspect
+import json
+import os
+import pickle
+import tempfile
+import uuid
+from pathlib import Path
+
+METHODS = ["mtime", "hash"]
+# folder containing one record per output file
+MANIFEST_NAME = ".znamutils_manifest"
+
+
+def source_hash(func):
+    """Hash the source code of a function
+
+    Args:
+        func (function): Function to hash
+
+    Returns:
+        str: Hexadecimal sha256 of the source, or of the bytecode if the source is not
+            available
+    """
+    try:
+        source = inspect.getsource(func).encode("utf-8")
+    except (OSError, TypeError):
+        source = func.__code__.co_code + repr(func.__code__.co_consts).encode("utf-8")
+    return hashlib.sha256(func.__qualname__.encode("utf-8") + source).hexdigest()
+
+
+def _update_hash(hasher, value):
+    """Feed the content of a value to a hasher, recursing into containers"""
+    if isinstance(value, (str, bytes, int, float, bool, complex, type(None))):
+        hasher.update(f"{type(value).__name__}:{value!r};".encode("utf-8"))
+    elif isinstance(value, os.PathLike):
+        # a path is the same argument as its string
+        _update_hash(hasher, os.fspath(value))
+    elif isinstance(value, (list, tuple)):
+        hasher.update(f"{type(value).__name__}:{len(value)}[".encode("utf-8"))
+        for element in value:
+            _update_hash(hasher, element)
+        hasher.update(b"]")
+    elif isinstance(value, dict):
+        hasher.update(f"dict:{len(value)}{{".encode("utf-8"))
+        items = sorted((stable_hash(k), stable_hash(v)) for k, v in value.items())
+        for key_hash, value_hash in items:
+            hasher.update(f"{key_hash}={value_hash};".encode("utf-8"))
+        hasher.update(b"}")
+    elif isinstance(value, (set, frozenset)):
+        # the order of sets depends on the hash randomisation of each session
+        hasher.update(f"{type(value).__name__}:{len(value)}{{".encode("utf-8"))
+        for element_hash in sorted(stable_hash(v) for v in value):
+            hasher.update(f"{element_hash};".encode("utf-8"))
+        hasher.update(b"}")
+    elif type(value).__module__ == "numpy" and hasattr(value, "dtype"):
+        hasher.update(f"numpy:{value.dtype.str}:{value.shape}:".encode("utf-8"))
+        if value.dtype.hasobject:
+            _update_hash(hasher, value.tolist())
+        else:
+            hasher.update(value.tobytes(order="C"))
+    else:
+        hasher.update(pickle.dumps(value, protocol=4))
+
+
+def stable_hash(value):
+    """Hash a value so that equal values have the same hash across sessions
+
+    Containers, sets, paths and numpy arrays are hashed by content. Other objects are
+    hashed through their pickle.
+
+    Args:
+        value: Value to hash
+
+    Returns:
+        str: Hexadecimal sha256 of the value
+
+    Raises:
+        pickle.PicklingError, TypeError or AttributeError: If the value contains an
+            object that cannot be pickled
+    """
+    hasher = hashlib.sha256()
+    _update_hash(hasher, value)
+    return hasher.hexdigest()
+
+
+def arguments_hash(arguments, ignore=()):
+    """Hash the arguments of a function call
+
+    Arguments are hashed by content (see `stable_hash`). Arguments that cannot be
+    pickled get a new random hash, so that the call is never up to date.
+
+    Args:
+        arguments (dict): Dictionary of argument names and values
+        ignore (list, optional): Names of the arguments to ignore. Defaults to ().
+
+    Returns:
+        str: Hexadecimal sha256 of the arguments
+    """
+    arguments = {k: v for k, v in arguments.items() if k not in ignore}
+    try:
+        return stable_hash(arguments)
+    except (pickle.PicklingError, TypeError, AttributeError):
+        return uuid.uuid4().hex
+
+
+def file_signature(path, method="mtime"):
+    """Signature of a file, used to know if it changed
+
+    Args:
+        path (str): Path to the file
+        method (str, optional): "mtime" to use modification time and size, "hash" to
+            hash the content. Directories always use "mtime". Defaults to "mtime".
+
+    Returns:
+        list or str: Signature of the file, None if it does not exist
+    """
+    path = Path(path)
+    if not path.exists():
+        return None
+    if method == "mtime" or path.is_dir():
+        stat = path.stat()
+        return [stat.st_mtime_ns, stat.st_size]
+    if method not in METHODS:
+        raise ValueError(f"Unknown method {method}. Must be one of {METHODS}")
+    hasher = hashlib.sha256()
+    with open(path, "rb") as fhandle:
+        for chunk in iter(lambda: fhandle.read(2**20), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def get_paths(arguments, names):
+    """Get the paths contained in some arguments
+
+    Args:
+        arguments (dict): Dictionary of argument names and values
+        names (list): Names of the arguments containing a path or a list of paths
+
+    Returns:
+        list: List of resolved paths as strings
+    """
+    paths = []
+    for name in names:
+        value = arguments.get(name)
+        if value is None:
+            continue
+        if isinstance(value, (str, os.PathLike)):
+            value = [value]
+        paths.extend(str(Path(v).expanduser().resolve()) for v in value)
+    return paths
+
+
+def _record_path(output):
+    output = Path(output)
+    return output.parent / MANIFEST_NAME / f"{output.name}.json"
+
+
+def _read_record(output):
+    try:
+        with open(_record_path(output)) as fhandle:
+            return json.load(fhandle)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def _record(func_hash, args_hash, inputs, outputs, method):
+    return dict(
+        source=func_hash,
+        arguments=args_hash,
+        inputs={p: file_signature(p, method) for p in inputs},
+        outputs={p: file_signature(p, method) for p in outputs},
+    )
+
+
+def is_up_to_date(func_hash, args_hash, inputs, outputs, method="mtime"):
+    """Check whether outputs are up to date with inputs, function and arguments
+
+    Args:
+        func_hash (str): Hash of the function source (see `source_hash`)
+        args_hash (str): Hash of the other arguments (see `arguments_hash`)
+        inputs (list): List of input paths
+        outputs (list): List of output paths
+        method (str, optional): How to compare files, "mtime" or "hash". Defaults to
+            "mtime".
+
+    Returns:
+        bool: True if all outputs exist and nothing changed since they were produced
+    """
+    if not outputs:
+        return False
+    current = None
+    for output in outputs:
+        previous = _read_record(output)
+        if previous is None:
+            return False
+        if current is None:
+            current = _record(func_hash, args_hash, inputs, outputs, method)
+            if None in current["outputs"].values():
+                return False
+        if previous != current:
+            return False
+    return True
+
+
+def record_outputs(func_hash, args_hash, inputs, outputs, method="mtime"):
+    """Record that outputs were produced from the current inputs
+
+    Each output has its own record in the manifest folder next to it, replaced
+    atomically, so that concurrent jobs writing different outputs of a folder do not
+    interfere.
+
+    Args:
+        func_hash (str): Hash of the function source (see `source_hash`)
+        args_hash (str): Hash of the other arguments (see `arguments_hash`)
+        inputs (list): List of input paths
+        outputs (list): List of output paths
+        method (str, optional): How to compare files, "mtime" or "hash". Defaults to
+            "mtime".
+    """
+    record = json.dumps(_record(func_hash, args_hash, inputs, outputs, method))
+    for output in outputs:
+        target = _record_path(output)
+        if not target.parent.parent.exists():
+            continue
+        target.parent.mkdir(exist_ok=True)
+        fd, tmp_file = tempfile.mkstemp(dir=target.parent, prefix=target.name)
+        try:
+            with os.fdopen(fd, "w") as fhandle:
+                fhandle.write(record)
+            os.replace(tmp_file, target)
+        except BaseException:
+            os.unlink(tmp_file)
+            raise
@@ -0,0 +1,211 @@
+"""Memoization of function calls run locally
+
+Results are kept in a bounded in-memory LRU cache and, optionally, in a folder on disk.
+On disk, numpy arrays are saved as `.npy` files that are memory-mapped when read back,
+and other results are pickled. Calls are identified by a hash of the source of the
+function and of the values of its arguments (see `incremental.stable_hash`).
+"""
+import inspect
+import os
+import pickle
+import tempfile
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+from znamutils import incremental
+
+
+def _is_array(value):
+    """Whether a value can be saved as `.npy` and memory-mapped"""
+    if type(value).__module__ != "numpy":
+        return False
+    import numpy as np
+
+    return (
+        isinstance(value, np.ndarray) and value.ndim > 0 and not value.dtype.hasobject
+    )
+
+
+def _touch(path):
+    """Mark a cache entry as recently used"""
+    # the python clock is finer than the file system clock
+    now = time.time_ns()
+    try:
+        os.utime(path, ns=(now, now))
+    except FileNotFoundError:
+        # evicted by another process
+        pass
+
+
+class Memoizer:
+    """Cache of the results of a function
+
+    `stats` counts the calls found in memory (hits) or on disk (disk_hits), the calls
+    that ran the function (misses), the calls with arguments that cannot be hashed and
+    are not cached (unhashable) and the results evicted from memory (evictions) or from
+    disk (disk_evictions). Results in memory are returned as is, they should not
+    be modified.
+
+    Args:
+        func (function): Function to memoize
+        max_items (int, optional): Maximum number of results kept in memory. Defaults
+            to 128.
+        folder (str, optional): Folder of the on-disk cache. If None, results are only
+            kept in memory. Defaults to None.
+        max_bytes (int, optional): Maximum size of the on-disk cache of this function
+            in bytes. The least recently used results are deleted first. Defaults to
+            1GB.
+    """
+
+    def __init__(self, func, max_items=128, folder=None, max_bytes=2**30):
+        self.func = func
+        self.max_items = max_items
+        self.folder = Path(folder).expanduser() if folder is not None else None
+        self.max_bytes = max_bytes
+        self.prefix = f"{func.__name__}_"
+        self._source_hash = incremental.source_hash(func)
+        self._signature = inspect.signature(func)
+        self._memory = OrderedDict()
+        self.stats = {}
+        self.clear_stats()
+
+    def clear_stats(self):
+        """Reset the hit and miss counts"""
+        self.stats.update(
+            hits=0, disk_hits=0, misses=0, unhashable=0, evictions=0, disk_evictions=0
+        )
+
+    def clear(self, disk=True):
+        """Empty the cache
+
+        Args:
+            disk (bool, optional): Whether to also delete the on-disk cache. Defaults
+                to True.
+        """
+        self._memory.clear()
+        if disk:
+            for path in self._disk_entries():
+                path.unlink(missing_ok=True)
+
+    def key(self, arguments):
+        """Key of a call
+
+        Args:
+            arguments (dict): Arguments of the call, by name
+
+        Returns:
+            str: Hexadecimal hash of the function source and the arguments
+        """
+        return incremental.stable_hash([self._source_hash, arguments])
+
+    def __call__(self, *args, **kwargs):
+        """Return the cached result of a call, running the function if needed
+
+        Args:
+            *args: Positional arguments of the function
+            **kwargs: Keyword arguments of the function
+
+        Returns:
+            Output of the function. Arrays read from disk are read-only memory maps.
+        """
+        bound = self._signature.bind(*args, **kwargs)
+        bound.apply_defaults()
+        try:
+            key = self.key(bound.arguments)
+        except (pickle.PicklingError, TypeError, AttributeError):
+            # for instance a lambda or a file handle, run without cache
+            self.stats["unhashable"] += 1
+            return self.func(*args, **kwargs)
+        if key in self._memory:
+            self._memory.move_to_end(key)
+            self.stats["hits"] += 1
+            return self._memory[key]
+        found, value = self._read(key)
+        if found:
+            self.stats["disk_hits"] += 1
+        else:
+            self.stats["misses"] += 1
+            value = self.func(*args, **kwargs)
+            self._write(key, value)
+        self._memory[key] = value
+        while len(self._memory) > self.max_items:
+            self._memory.popitem(last=False)
+            self.stats["evictions"] += 1
+        return value
+
+    def _disk_entries(self):
+        if self.folder is None or not self.folder.exists():
+            return []
+        # keys are 64 characters long, ignore the entries of other functions
+        name_length = len(self.prefix) + 64
+        return [
+            p
+            for p in self.folder.glob(f"{self.prefix}*")
+            if p.suffix in (".npy", ".pkl") and len(p.stem) == name_length
+        ]
+
+    def _read(self, key):
+        if self.folder is None:
+            return False, None
+        for suffix in (".npy", ".pkl"):
+            path = self.folder / f"{self.prefix}{key}{suffix}"
+            try:
+                if suffix == ".npy":
+                    import numpy as np
+
+                    value = np.load(path, mmap_mode="r")
+                else:
+                    with open(path, "rb") as fhandle:
+                        value = pickle.load(fhandle)
+            except FileNotFoundError:
+                continue
+            _touch(path)
+            return True, value
+        return False, None
+
+    def _write(self, key, value):
+        if self.folder is None:
+            return
+        self.folder.mkdir(parents=True, exist_ok=True)
+        suffix = ".npy" if _is_array(value) else ".pkl"
+        target = self.folder / f"{self.prefix}{key}{suffix}"
+        # a unique temporary file, concurrent writers of the same result all succeed
+        fd, tmp_file = tempfile.mkstemp(dir=self.folder, prefix=f".{target.name}.")
+        try:
+            with os.fdopen(fd, "wb") as fhandle:
+                if suffix == ".npy":
+                    import numpy as np
+
+                    np.save(fhandle, value, allow_pickle=False)
+                else:
+                    pickle.dump(value, fhandle, protocol=pickle.HIGHEST_PROTOCOL)
+        except (pickle.PicklingError, TypeError, AttributeError) as err:
+            os.unlink(tmp_file)
+            print(f"Warning: {self.func.__name__} output not cached on disk ({err})")
+            return
+        except BaseException:
+            os.unlink(tmp_file)
+            raise
+        os.replace(tmp_file, target)
+        _touch(target)
+        self._evict_disk()
+
+    def _evict_disk(self):
+        entries = []
+        for path in self._disk_entries():
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime_ns, stat.st_size, path))
+        total = sum(e[1] for e in entries)
+        for _, size, path in sorted(entries, key=lambda e: e[0]):
+            if total <= self.max_bytes:
+                break
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+            total -= size
+            self.stats["disk_evictions"] += 1
@@ -0,0 +1,226 @@
+"""Load-aware choice of the partition of slurm jobs
+
+A snapshot of the nodes (`sinfo`) and of the queue (`squeue`) is taken once and reused
+for `SNAPSHOT_TTL` seconds, so that large sweeps do not query the slurm controller for
+each job. Each job is routed to the candidate partition where it is expected to start
+first, and the snapshot is updated with the jobs routed since it was taken, so that a
+sweep is spread over the partitions.
+"""
+import shlex
+import subprocess
+import time
+
+# seconds before the snapshot is taken again
+SNAPSHOT_TTL = 60
+AVAILABLE_NODE_STATES = ["idle", "mix", "mixed", "alloc", "allocated", "comp"]
+_SNAPSHOT = dict(time=None, partitions=None)
+
+
+def parse_time(time_str):
+    """Convert a slurm time string to seconds
+
+    Args:
+        time_str (str): Time as "MM", "MM:SS", "HH:MM:SS", "D-HH", "D-HH:MM" or
+            "D-HH:MM:SS"
+
+    Returns:
+        float: Number of seconds, None if unlimited
+    """
+    time_str = str(time_str).strip()
+    if time_str.lower() in ("infinite", "unlimited"):
+        return None
+    days = 0
+    if "-" in time_str:
+        days, time_str = time_str.split("-")
+        parts = [int(p) for p in time_str.split(":")]
+        hours, minutes, seconds = parts + [0] * (3 - len(parts))
+    else:
+        parts = [int(p) for p in time_str.split(":")]
+        if len(parts) == 1:
+            hours, minutes, seconds = 0, parts[0], 0
+        elif len(parts) == 2:
+            hours, minutes, seconds = 0, parts[0], parts[1]
+        else:
+            hours, minutes, seconds = parts
+    return float(((int(days) * 24 + hours) * 60 + minutes) * 60 + seconds)
+
+
+def parse_mem(mem_str):
+    """Convert a slurm memory string to megabytes
+
+    Args:
+        mem_str (str): Memory, with an optional K, M, G or T suffix (default M)
+
+    Returns:
+        float: Memory in megabytes
+    """
+    mem_str = str(mem_str).strip().upper()
+    units = {"K": 1 / 1024, "M": 1, "G": 1024, "T": 1024**2}
+    if mem_str[-1] in units:
+        return float(mem_str[:-1]) * units[mem_str[-1]]
+    return float(mem_str)
+
+
+def _run(command):
+    return subprocess.check_output(shlex.split(command)).decode("utf-8").splitlines()
+
+
+def take_snapshot():
+    """Query the state of the nodes and of the queue
+
+    Returns:
+        dict: For each partition, a dictionary with the `max_time` of jobs in seconds,
+            the list of available `nodes` (dictionaries with `cpus`, `mem`,
+            `free_cpus` and `free_mem`, memory in megabytes), and the cpu-seconds
+            `pending` in the queue and still `running`
+    """
+    partitions = {}
+    for line in _run('sinfo -h -N -o "%P|%n|%t|%c|%m|%l|%C|%e"'):
+        if not line.strip():
+            continue
+        name, _, state, cpus, mem, max_time, cpu_states, free_mem = line.split("|")
+        part = partitions.setdefault(
+            name.rstrip("*"),
+            dict(max_time=parse_time(max_time), nodes=[], pending=0.0, running=0.0),
+        )
+        if state.rstrip("*~#$@+-^!%") not in AVAILABLE_NODE_STATES:
+            continue
+        idle_cpus = int(cpu_states.split("/")[1])
+        part["nodes"].append(
+            dict(
+                cpus=int(cpus),
+                mem=parse_mem(mem),
+                free_cpus=idle_cpus,
+                free_mem=parse_mem(free_mem) if free_mem != "N/A" else parse_mem(mem),
+            )
+        )
+    for line in _run('squeue -h -t PD,R -o "%P|%t|%C|%l|%L"'):
+        if not line.strip():
+            continue
+        names, state, cpus, time_limit, time_left = line.split("|")
+        duration = time_limit if state == "PD" else time_left
+        duration = parse_time(duration) if duration != "INVALID" else None
+        for name in names.split(","):
+            if name not in partitions or duration is None:
+                continue
+            key = "pending" if state == "PD" else "running"
+            partitions[name][key] += int(cpus) * duration
+    return partitions
+
+
+def get_snapshot(ttl=None):
+    """Get the cached snapshot, taking a new one if it is older than ttl
+
+    Args:
+        ttl (float, optional): Maximum age of the snapshot in seconds. Defaults to
+            `SNAPSHOT_TTL`.
+
+    Returns:
+        dict: Snapshot, see `take_snapshot`
+    """
+    if ttl is None:
+        ttl = SNAPSHOT_TTL
+    now = time.monotonic()
+    if _SNAPSHOT["time"] is None or now - _SNAPSHOT["time"] > ttl:
+        _SNAPSHOT.update(time=now, partitions=take_snapshot())
+    return _SNAPSHOT["partitions"]
+
+
+def reset_snapshot():
+    """Forget the cached snapshot"""
+    _SNAPSHOT.update(time=None, partitions=None)
+
+
+def job_request(slurm_options):
+    """Resources requested by a job
+
+    Args:
+        slurm_options (dict): Options given to sbatch
+
+    Returns:
+        int: Number of cpus
+        float: Memory in megabytes
+        float: Time limit in seconds, None if not set
+    """
+    cpus = int(slurm_options.get("ntasks", 1)) * int(
+        slurm_options.get("cpus-per-task", 1)
+    )
+    mem = parse_mem(slurm_options.get("mem", "0"))
+    time_limit = slurm_options.get("time")
+    if time_limit is not None:
+        time_limit = parse_time(time_limit)
+    return cpus, mem, time_limit
+
+
+def expected_start(partition, cpus, mem, time_limit):
+    """Estimate the time before a job starts on a partition
+
+    The job starts immediately if a node has enough idle resources and no job is
+    pending. Otherwise it waits for the pending and running work to be spread over the
+    cpus of the partition.
+
+    Args:
+        partition (dict): Partition of a snapshot (see `take_snapshot`)
+        cpus (int): Number of cpus requested
+        mem (float): Memory requested in megabytes
+        time_limit (float): Time limit requested in seconds, or None
+
+    Returns:
+        float: Expected wait in seconds, None if the job cannot run on this partition
+    """
+    max_time = partition["max_time"]
+    if max_time is not None and (time_limit is None or time_limit > max_time):
+        return None
+    nodes = [n for n in partition["nodes"] if n["cpus"] >= cpus and n["mem"] >= mem]
+    if not nodes:
+        return None
+    fits_now = any(n["free_cpus"] >= cpus and n["free_mem"] >= mem for n in nodes)
+    if fits_now and not partition["pending"]:
+        return 0.0
+    total_cpus = sum(n["cpus"] for n in partition["nodes"])
+    return (partition["pending"] + partition["running"]) / total_cpus
+
+
+def select_partition(candidates, slurm_options, ttl=None):
+    """Choose the candidate partition where a job is expected to start first
+
+    The job is then added to the cached snapshot, so that the next jobs account for it.
+
+    Args:
+        candidates (list): Names of the partitions the job can run on
+        slurm_options (dict): Options given to sbatch, used to know the cpus, memory
+            and time requested
+        ttl (float, optional): Maximum age of the snapshot in seconds. Defaults to
+            `SNAPSHOT_TTL`.
+
+    Returns:
+        str: Name of the partition, None if the snapshot could not be taken
+    """
+    try:
+        snapshot = get_snapshot(ttl)
+    except (subprocess.CalledProcessError, OSError) as err:
+        print(f"Warning: cannot get the load of the partitions ({err})")
+        return None
+    cpus, mem, time_limit = job_request(slurm_options)
+    best, best_wait = None, None
+    for name in candidates:
+        if name not in snapshot:
+            continue
+        wait = expected_start(snapshot[name], cpus, mem, time_limit)
+        if wait is not None and (best_wait is None or wait < best_wait):
+            best, best_wait = name, wait
+    if best is None:
+        raise ValueError(f"No partition of {candidates} can run the job")
+
+    # account for the job in the snapshot
+    partition = snapshot[best]
+    duration = time_limit if time_limit is not None else partition["max_time"] or 0
+    for node in partition["nodes"]:
+        if best_wait == 0 and node["free_cpus"] >= cpus and node["free_mem"] >= mem:
+            node["free_cpus"] -= cpus
+            node["free_mem"] -= mem
+            partition["running"] += cpus * duration
+            break
+    else:
+        partition["pending"] += cpus * duration
+    return best
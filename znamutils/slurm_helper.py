@@ -1,8 +1,47 @@
 """Function to help to generate and run slurm scripts"""
+import hashlib
+import io
+import os
+import py_compile
+import re
 import shlex
 import subprocess
+import sys
+import sysconfig
+import tempfile
+import time
+import zipfile
+from functools import lru_cache
+from importlib.util import find_spec
 from pathlib import Path
 
+from znamutils.telemetry import TELEMETRY
+
+# code to start and stop each profiler in generated python scripts
+PROFILERS = {
+    "cprofile": (
+        "import cProfile\n\n_profiler = cProfile.Profile()\n_profiler.enable()\n",
+        "    _profiler.disable()\n    _profiler.dump_stats({profile_file})\n",
+    ),
+    "tracemalloc": (
+        "import tracemalloc\n\ntracemalloc.start()\n",
+        "    tracemalloc.take_snapshot().dump({profile_file})\n",
+    ),
+    "pyinstrument": (
+        "from pyinstrument import Profiler\n\n_profiler = Profiler()\n"
+        + "_profiler.start()\n",
+        "    _profiler.stop()\n    _profiler.last_session.save({profile_file})\n",
+    ),
+}
+PROFILE_EXTENSIONS = {
+    "cprofile": ".prof",
+    "tracemalloc": ".tracemalloc",
+    "pyinstrument": ".pyisession",
+}
+DEFAULT_SLURM_OPTIONS = dict(ntasks=1, time="12:00:00", mem="32G", partition="ncpu")
+# placeholders of python script templates, such as "XXX_ARGUMENT_XXX"
+TEMPLATE_PLACEHOLDER = re.compile(r'"XXX_([^"\n]+?)_XXX"')
+
 
 def run_slurm_batch(
     script_path,
@@ -10,9 +49,15 @@ def run_slurm_batch(
     job_dependency=None,
     env_vars=None,
     dry_run=False,
+    label=None,
+    script_args=None,
+    partition=None,
 ):
     """Run a slurm script
 
+    The latency and outcome of the sbatch call are recorded in
+    `znamutils.telemetry.TELEMETRY`.
+
     Args:
         script_path (str): Full path to the script
         dependency_type (str, optional): Type of dependence on previous jobs.
@@ -24,6 +69,12 @@ def run_slurm_batch(
         env_vars (dict, optional): Dictionary of environment variables to pass to the
             script. Defaults to None.
         dry_run (bool, optional): Whether to run the command or just print it.
+        label (str, optional): Name used to group the job in the telemetry. Defaults
+            to the name of the script.
+        script_args (list, optional): Arguments to pass to the script. Defaults to
+            None.
+        partition (str, optional): Partition to submit to, overriding the partition of
+            the script. Defaults to None.
 
     Returns:
         str: Job ID of the sbatch job
@@ -40,18 +91,156 @@ def run_slurm_batch(
     else:
         vars = ""
 
+    if partition is not None:
+        vars += f"--partition={partition} "
+
     command = f"sbatch {vars}{dep}{script_path}"
+    if script_args:
+        command += " " + " ".join([shlex.quote(str(a)) for a in script_args])
 
     if dry_run:
         print(command)
         return command
 
-    procout = subprocess.check_output(shlex.split(command))
+    if label is None:
+        label = Path(script_path).stem
+    return _submit(command, label)
+
+
+def _submit(command, label):
+    """Run a sbatch command, record it in the telemetry and return the job id"""
+    start = time.time()
+    try:
+        procout = subprocess.check_output(shlex.split(command))
+    except (subprocess.CalledProcessError, OSError) as err:
+        TELEMETRY.record_submission(label, time.time() - start, error=str(err))
+        raise
     # get the job id
     job_id = procout.decode("utf-8").split(" ")[-1].strip()
+    TELEMETRY.record_submission(label, time.time() - start, job_id=job_id)
     return job_id
 
 
+def collapse_job_ids(job_ids):
+    """Collapse job array members into their parent array job
+
+    Job IDs of the form `ARRAYID_TASKID` (or `ARRAYID_[1-10]`) are replaced by
+    `ARRAYID`. Depending on the array job means depending on all of its tasks, so this
+    should only be used when all tasks of the array are part of the dependency.
+    Duplicates are removed, preserving order.
+
+    Args:
+        job_ids (list): List of job IDs
+
+    Returns:
+        list: List of unique job IDs as strings
+    """
+    collapsed = []
+    for job_id in job_ids:
+        job_id = str(job_id).split("_")[0]
+        if job_id not in collapsed:
+            collapsed.append(job_id)
+    return collapsed
+
+
+def submit_barrier_job(
+    job_ids, dependency_type="afterok", slurm_options=None, dry_run=False
+):
+    """Submit a lightweight job that finishes once all job_ids are done
+
+    The barrier job does nothing but can be used as a single dependency in place of
+    many jobs. It is submitted with `--kill-on-invalid-dep=yes` so that it is cancelled
+    if its dependency can never be satisfied.
+
+    Args:
+        job_ids (list): List of job IDs the barrier waits for
+        dependency_type (str, optional): Type of dependence on job_ids. Defaults to
+            "afterok".
+        slurm_options (dict, optional): Options to give to sbatch, will update the
+            default barrier options. The partition defaults to the partition of
+            `DEFAULT_SLURM_OPTIONS`. Defaults to None.
+        dry_run (bool, optional): Whether to run the command or just print it.
+
+    Returns:
+        str: Job ID of the barrier job (or the command if dry_run is True)
+    """
+    if dependency_type == "aftercorr":
+        raise ValueError("aftercorr dependencies cannot go through a barrier job")
+    default_options = {
+        "job-name": "barrier",
+        "partition": DEFAULT_SLURM_OPTIONS["partition"],
+        "ntasks": 1,
+        "time": "00:01:00",
+        "mem": "100M",
+        "output": "/dev/null",
+        "kill-on-invalid-dep": "yes",
+    }
+    if slurm_options is None:
+        slurm_options = {}
+    slurm_options = dict(default_options, **slurm_options)
+    options = " ".join([f"--{k}={v}" for k, v in slurm_options.items()])
+    dep = f"--dependency={dependency_type}:{':'.join(map(str, job_ids))}"
+    command = f"sbatch {options} {dep} --wrap=true"
+
+    if dry_run:
+        print(command)
+        return command
+
+    return _submit(command, "barrier")
+
+
+def reduce_job_dependency(
+    job_ids,
+    dependency_type="afterok",
+    max_dependencies=500,
+    collapse_arrays=False,
+    barrier_options=None,
+):
+    """Reduce a large list of job IDs to a short dependency
+
+    Job array members can first be collapsed into their array job (see
+    `collapse_job_ids`). If more than `max_dependencies` jobs remain, they are split in
+    chunks, each chunk is replaced by a barrier job and the process is repeated until
+    the dependency is short enough, building a hierarchy of barriers.
+
+    Args:
+        job_ids (list): List of job IDs
+        dependency_type (str, optional): Type of dependence on job_ids. Defaults to
+            "afterok".
+        max_dependencies (int, optional): Maximum number of job IDs in a single
+            dependency. Defaults to 500.
+        collapse_arrays (bool, optional): Whether to collapse job array members into
+            their array job. Only valid if all tasks of the arrays are in job_ids.
+            Defaults to False.
+        barrier_options (dict, optional): Options to give to sbatch for the barrier
+            jobs. Defaults to None.
+
+    Returns:
+        str: Job IDs separated by ":", or None if job_ids is empty
+        str: Dependency type to use with these job IDs
+    """
+    if collapse_arrays:
+        job_ids = collapse_job_ids(job_ids)
+    else:
+        job_ids = [str(j) for j in job_ids]
+    if not len(job_ids):
+        return None, dependency_type
+    assert max_dependencies > 1, "max_dependencies should be larger than 1"
+
+    while len(job_ids) > max_dependencies:
+        job_ids = [
+            submit_barrier_job(
+                job_ids[i : i + max_dependencies],
+                dependency_type=dependency_type,
+                slurm_options=barrier_options,
+            )
+            for i in range(0, len(job_ids), max_dependencies)
+        ]
+        # barriers only run if their own dependency is satisfied
+        dependency_type = "afterok"
+    return ":".join(job_ids), dependency_type
+
+
 def create_slurm_sbatch(
     target_folder,
     script_name,
@@ -63,9 +252,15 @@ def create_slurm_sbatch(
     print_job_id=True,
     add_jobid_to_output=False,
     env_vars_to_pass=None,
+    pass_arguments=False,
+    content_hash=False,
+    export_vars=None,
 ):
     """Create a slurm sh script that will call a python script
 
+    The script is written atomically and is not rewritten if it already exists with
+    the same content.
+
     Args:
         target_folder (str): Where to write the script?
         script_name (str): Name of the script
@@ -83,6 +278,17 @@ def create_slurm_sbatch(
         env_vars_to_pass (dict, optional): Dictionary of environment variables to pass
             to the script. Keys are the name of the argument expected by the python
             script and values are the environment variable. Defaults to None.
+        pass_arguments (bool, optional): Whether to pass the arguments given to sbatch
+            after the script name to the python script. Defaults to False.
+        content_hash (bool, optional): Whether to add the hash of the content to the
+            name of the script (see `write_hashed_file`), so that different scripts
+            never overwrite each other. Log files are still named after script_name.
+            Defaults to False.
+        export_vars (dict, optional): Environment variables exported before calling
+            the python script. Defaults to None.
+
+    Returns:
+        pathlib.Path: Path to the script
     """
     if not script_name.endswith(".sh"):
         script_name += ".sh"
@@ -91,15 +297,16 @@ def create_slurm_sbatch(
 
     target_folder = Path(target_folder)
     default_options = dict(
-        ntasks=1,
-        time="12:00:00",
-        mem="32G",
-        partition="ncpu",
+        DEFAULT_SLURM_OPTIONS,
         output=str(target_folder / script_name.replace(".sh", ".out")),
     )
     if add_jobid_to_output or env_vars_to_pass:
         default_options["output"] = default_options["output"].replace(".out", "_%j.out")
 
+    if content_hash:
+        # otherwise jobs would be named after the hashed script
+        default_options["job-name"] = script_name[:-3]
+
     if split_err_out:
         default_options["error"] = default_options["output"].replace(".out", ".err")
 
@@ -108,7 +315,7 @@ def create_slurm_sbatch(
 
     slurm_options = dict(default_options, **slurm_options)
 
-    with open(target_folder / script_name, "w") as fhandle:
+    with io.StringIO() as fhandle:
         fhandle.write("#!/bin/bash\n")
         options = "\n".join([f"#SBATCH --{k}={v}" for k, v in slurm_options.items()])
         fhandle.writelines(options)
@@ -130,6 +337,10 @@ def create_slurm_sbatch(
                 "",
             ]
         )
+        if export_vars:
+            boiler += "".join(
+                f"export {k}={shlex.quote(str(v))}\n" for k, v in export_vars.items()
+            )
         fhandle.write(boiler)
 
         cmd = f"python {python_script}"
@@ -140,8 +351,15 @@ def create_slurm_sbatch(
                 elif k.startswith("-"):
                     raise ValueError(f"Short options are not supported: {k}")
                 cmd += f" {k} ${v}"
+        if pass_arguments:
+            cmd += ' "$@"'
         # and the real call
         fhandle.write(f"\n\n{cmd}\n")
+        content = fhandle.getvalue()
+
+    if content_hash:
+        return write_hashed_file(target_folder, script_name[:-3], ".sh", content)
+    return write_file_atomic(target_folder / script_name, content)
 
 
 def python_script_single_func(
@@ -153,9 +371,17 @@ def python_script_single_func(
     from_imports=None,
     path2string=True,
     format_numpy_objects=True,
+    profile=None,
+    profile_prefix=None,
+    sys_path=None,
+    payload=False,
+    content_hash=False,
 ):
     """Create a python script that will call a function
 
+    The script is written atomically and is not rewritten if it already exists with
+    the same content.
+
     Args:
         target_file (str): Where to write the script?
         function_name (str): Name of the function to call
@@ -173,9 +399,32 @@ def python_script_single_func(
             strings. Defaults to True.
         format_numpy_objects (bool, optional): Whether to format numpy numbers as python
             basic types. Defaults to True.
+        profile (str, optional): Profiler to wrap the function call with, one of
+            "cprofile", "tracemalloc" or "pyinstrument". Defaults to None.
+        profile_prefix (str, optional): Prefix of the profile output file. The job ID
+            and an extension depending on the profiler are appended. Required if
+            profile is not None. Defaults to None.
+        sys_path (list, optional): List of paths, for instance code bundles created by
+            `bundle_modules`, to add at the start of `sys.path` before any import.
+            Defaults to None.
+        payload (bool, optional): Whether to read additional arguments from a payload
+            file given with `--payload` on the command line (see
+            `write_arguments_payload`). This allows many calls to share the same
+            script. Defaults to False.
+        content_hash (bool, optional): Whether to add the hash of the content to the
+            name of the script (see `write_hashed_file`). Defaults to False.
+
+    Returns:
+        pathlib.Path: Path to the script
     """
 
     target_file = Path(target_file)
+    if profile is not None:
+        if profile not in PROFILERS:
+            raise ValueError(
+                f"Unknown profiler {profile}. Must be one of {list(PROFILERS)}"
+            )
+        assert profile_prefix is not None, "profile_prefix is required to profile"
     assert target_file.parent.exists(), f"{target_file.parent} does not exist"
 
     if vars2parse is None:
@@ -185,11 +434,20 @@ def python_script_single_func(
         imports = []
     elif isinstance(imports, str):
         imports = [imports]
+    else:
+        imports = list(imports)
 
-    if vars2parse and ("argparse" not in imports):
+    if (vars2parse or payload) and ("argparse" not in imports):
         imports.append("argparse")
-
-    with open(target_file, "w") as fhandle:
+    if payload and ("runpy" not in imports):
+        imports.append("runpy")
+
+    with io.StringIO() as fhandle:
+        if sys_path:
+            fhandle.write("import sys\n\n")
+            for path in reversed(sys_path):
+                fhandle.write(f"sys.path.insert(0, {repr(str(path))})\n")
+            fhandle.write("\n")
         for imp in imports:
             fhandle.write(f"import {imp}\n")
         fhandle.write("\n")
@@ -197,25 +455,366 @@ def python_script_single_func(
             for module, function in from_imports.items():
                 fhandle.write(f"from {module} import {function}\n")
             fhandle.write("\n")
-        if vars2parse:
+        if vars2parse or payload:
             fhandle.write("parser = argparse.ArgumentParser()\n")
             for k, v in vars2parse.items():
                 fhandle.write(f"parser.add_argument('--{v}')\n")
+            if payload:
+                fhandle.write("parser.add_argument('--payload')\n")
             fhandle.write("args = parser.parse_args()\n")
             fhandle.write("\n")
-
-        fhandle.write(f"{function_name}(")
+        if payload:
+            # evaluate the payload with the imports of the script
+            fhandle.write(
+                "_arguments = runpy.run_path(args.payload, init_globals=globals())"
+                + '["arguments"]\n'
+            )
+
+        call = f"{function_name}("
         if arguments is not None:
             for k, v in arguments.items():
-                if path2string and isinstance(v, Path):
-                    v = str(v)
-                if format_numpy_objects and type(v).__module__ == "numpy":
-                    v = v.tolist()
-                fhandle.write(f"{k}={repr(v)}, ")
+                v = _format_argument(v, path2string, format_numpy_objects)
+                call += f"{k}={v}, "
+        if payload:
+            call += "**_arguments, "
         if vars2parse:
             for k, v in vars2parse.items():
-                fhandle.write(f"{k}=args.{v}, ")
-        fhandle.write(")\n")
+                call += f"{k}=args.{v}, "
+        call += ")"
+
+        if profile is None:
+            fhandle.write(f"{call}\n")
+        else:
+            start, stop = PROFILERS[profile]
+            profile_file = (
+                f"{repr(str(profile_prefix) + '_')} + "
+                + "os.environ.get('SLURM_JOB_ID', 'local') + "
+                + repr(PROFILE_EXTENSIONS[profile])
+            )
+            fhandle.write("import os\n")
+            fhandle.write(start)
+            fhandle.write(f"try:\n    _output = {call}\nfinally:\n")
+            fhandle.write(stop.format(profile_file=profile_file))
+        content = fhandle.getvalue()
+
+    if content_hash:
+        return write_hashed_file(
+            target_file.parent, target_file.stem, target_file.suffix, content
+        )
+    return write_file_atomic(target_file, content)
+
+
+def _format_argument(value, path2string=True, format_numpy_objects=True):
+    """Python representation of an argument to write in a script"""
+    if path2string and isinstance(value, Path):
+        value = str(value)
+    if format_numpy_objects and type(value).__module__ == "numpy":
+        value = value.tolist()
+    return repr(value)
+
+
+def write_arguments_payload(
+    target_folder, name, arguments, path2string=True, format_numpy_objects=True
+):
+    """Write the arguments of a function call in a content-hashed payload file
+
+    The payload is a python file defining an `arguments` dictionary. It is read by the
+    scripts created by `python_script_single_func` with `payload=True`, so that the
+    script itself does not depend on the arguments.
+
+    Args:
+        target_folder (str): Where to write the payload?
+        name (str): Prefix of the payload name, the hash of the content is appended
+        arguments (dict): Dictionary of arguments to pass to the function
+        path2string (bool, optional): Whether to convert arguments that are paths to
+            strings. Defaults to True.
+        format_numpy_objects (bool, optional): Whether to format numpy numbers as python
+            basic types. Defaults to True.
+
+    Returns:
+        pathlib.Path: Path to the payload
+    """
+    content = "arguments = {\n"
+    for k, v in arguments.items():
+        v = _format_argument(v, path2string, format_numpy_objects)
+        content += f"    {repr(k)}: {v},\n"
+    content += "}\n"
+    return write_hashed_file(target_folder, f"{name}_args", ".py", content)
+
+
+def write_file_atomic(target_file, content):
+    """Write a text file atomically, unless it already has this content
+
+    The content is written to a temporary file in the same folder which is then
+    renamed, so that readers never see a partially written file.
+
+    Args:
+        target_file (str): Path to the file
+        content (str): Content of the file
+
+    Returns:
+        pathlib.Path: Path to the file
+    """
+    target_file = Path(target_file)
+    try:
+        if target_file.read_text() == content:
+            return target_file
+    except (FileNotFoundError, UnicodeDecodeError):
+        pass
+    fd, tmp_file = tempfile.mkstemp(dir=target_file.parent, prefix=target_file.name)
+    try:
+        with os.fdopen(fd, "w") as fhandle:
+            fhandle.write(content)
+        os.chmod(tmp_file, 0o644)
+        os.replace(tmp_file, target_file)
+    except BaseException:
+        os.unlink(tmp_file)
+        raise
+    return target_file
+
+
+def write_hashed_file(target_folder, name, suffix, content):
+    """Write a text file named after the hash of its content
+
+    The file is `<name>_<hash><suffix>`. If it already exists, it has the same content
+    and is reused without being rewritten. Otherwise it is written atomically, so that
+    concurrent writers of the same content are safe.
+
+    Args:
+        target_folder (str): Where to write the file?
+        name (str): Prefix of the file name
+        suffix (str): Suffix of the file name, for instance ".py"
+        content (str): Content of the file
+
+    Returns:
+        pathlib.Path: Path to the file
+    """
+    digest = hashlib.sha256(content.encode("utf-8")).hexdigest()[:12]
+    target_file = Path(target_folder) / f"{name}_{digest}{suffix}"
+    if target_file.exists():
+        return target_file
+    return write_file_atomic(target_file, content)
+
+
+def bundle_modules(module_names, target_folder):
+    """Bundle the source of python modules in a content-hashed zip file
+
+    The top-level package of each module is bundled with its source, precompiled
+    bytecode and data files, so that jobs import the code from a single file that does
+    not change when the source is edited. Standard library and installed
+    (site-packages) modules are not bundled, nor are packages containing compiled
+    extensions, which cannot be imported from a zip file. Source files that fail to
+    compile are bundled without bytecode, so that they only fail if they are imported.
+
+    The bundle is named after the hash of its content and is reused if it already
+    exists in target_folder. Add it to `sys.path` to import from it.
+
+    Args:
+        module_names (list): List of module names, for instance `["mypackage.sub"]`
+        target_folder (str): Where to write the bundle?
+
+    Returns:
+        pathlib.Path: Path to the bundle, or None if there was nothing to bundle
+    """
+    excluded = {
+        os.path.realpath(sysconfig.get_paths()[k])
+        for k in ("stdlib", "platstdlib", "purelib", "platlib")
+    }
+    sources = {}
+    for top_level in dict.fromkeys(m.split(".")[0] for m in module_names):
+        if not top_level or top_level == "__main__":
+            continue
+        spec = find_spec(top_level)
+        if spec is None or spec.origin in (None, "built-in", "frozen"):
+            continue
+        root = Path(spec.origin)
+        if spec.submodule_search_locations:
+            root = root.parent
+        if os.path.realpath(root.parent) in excluded:
+            continue
+        if root.is_dir():
+            files = sorted(root.rglob("*"))
+            if any(f.suffix in (".so", ".pyd") for f in files):
+                print(f"Warning: {top_level} has compiled extensions, not bundled")
+                continue
+            # skip bytecode caches and hidden files
+            files = [
+                f
+                for f in files
+                if f.is_file()
+                and f.suffix not in (".pyc", ".pyo")
+                and not any(
+                    p == "__pycache__" or p.startswith(".")
+                    for p in f.relative_to(root).parts
+                )
+            ]
+        else:
+            files = [root] if root.suffix == ".py" else []
+        for f in files:
+            sources[f.relative_to(root.parent).as_posix()] = f.read_bytes()
+    if not sources:
+        return None
+
+    hasher = hashlib.sha256(sys.implementation.cache_tag.encode())
+    for arcname in sorted(sources):
+        hasher.update(arcname.encode() + b"\0" + sources[arcname] + b"\0")
+    target_folder = Path(target_folder)
+    bundle = target_folder / f"code_bundle_{hasher.hexdigest()[:16]}.zip"
+    if bundle.exists():
+        return bundle
+
+    fd, tmp_bundle = tempfile.mkstemp(dir=target_folder, suffix=".zip.tmp")
+    os.close(fd)
+    try:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with zipfile.ZipFile(tmp_bundle, "w") as zfile:
+                for arcname in sorted(sources):
+                    _add_to_bundle(zfile, arcname, sources[arcname], bundle, tmp_dir)
+        os.replace(tmp_bundle, bundle)
+    except BaseException:
+        os.unlink(tmp_bundle)
+        raise
+    return bundle
+
+
+def _add_to_bundle(zfile, arcname, source, bundle, tmp_dir):
+    """Add a file to a bundle, with the bytecode of python files"""
+    # fixed timestamps to keep the zip content reproducible
+    date_time = (1980, 1, 1, 0, 0, 0)
+    zfile.writestr(zipfile.ZipInfo(arcname, date_time), source)
+    if not arcname.endswith(".py"):
+        return
+    src = Path(tmp_dir) / "source.py"
+    src.write_bytes(source)
+    try:
+        pyc = py_compile.compile(
+            str(src),
+            cfile=str(Path(tmp_dir) / "source.pyc"),
+            dfile=str(bundle / arcname),
+            doraise=True,
+            invalidation_mode=py_compile.PycInvalidationMode.UNCHECKED_HASH,
+        )
+    except py_compile.PyCompileError as err:
+        print(f"Warning: {arcname} does not compile, bundled without bytecode ({err})")
+        return
+    zfile.writestr(
+        zipfile.ZipInfo(arcname[:-3] + ".pyc", date_time), Path(pyc).read_bytes()
+    )
+
+
+class ScriptTemplate:
+    """Python script template, parsed once to be rendered many times
+
+    Arguments in the template should be of the form "XXX_ARGUMENT_XXX", including the
+    double quotes. They are replaced by the repr of `arguments["argument"]`. Names of
+    placeholders and keys of arguments are case insensitive.
+
+    Args:
+        source_script (str): Path to the template script
+    """
+
+    def __init__(self, source_script):
+        self.source_script = Path(source_script)
+        parts = TEMPLATE_PLACEHOLDER.split(self.source_script.read_text())
+        # literal text and placeholder names alternate
+        self._chunks = parts[0::2]
+        # names as written, to leave unfilled placeholders unchanged
+        self._raw_names = parts[1::2]
+        self._names = [name.upper() for name in self._raw_names]
+        self.placeholders = set(self._names)
+
+    def render(self, arguments=None, strict=True):
+        """Render the template in a single pass
+
+        Args:
+            arguments (dict, optional): Dictionary of arguments to replace in the
+                template. Defaults to None.
+            strict (bool, optional): Whether to raise an error if a placeholder has no
+                argument. If False, such placeholders are left unchanged. Defaults to
+                True.
+
+        Returns:
+            str: The rendered script
+        """
+        values = {k.upper(): repr(v) for k, v in (arguments or {}).items()}
+        if strict:
+            missing = self.placeholders - set(values)
+            if missing:
+                raise ValueError(f"Missing template arguments: {sorted(missing)}")
+        rendered = [self._chunks[0]]
+        for name, raw_name, chunk in zip(
+            self._names, self._raw_names, self._chunks[1:]
+        ):
+            rendered.append(values.get(name, f'"XXX_{raw_name}_XXX"'))
+            rendered.append(chunk)
+        return "".join(rendered)
+
+    def write(
+        self, target_folder, target_script_name=None, arguments=None, strict=True
+    ):
+        """Render the template and write it to a file
+
+        Args:
+            target_folder (str): Where to write the script?
+            target_script_name (str, optional): Name of the target script if different
+                from source_script. Defaults to None.
+            arguments (dict, optional): Dictionary of arguments to replace in the
+                template. Defaults to None.
+            strict (bool, optional): Whether to raise an error if a placeholder has no
+                argument. Defaults to True.
+
+        Returns:
+            pathlib.Path: Path to the script
+        """
+        if target_script_name is None:
+            target_script_name = self.source_script.name
+        return self.write_many(
+            target_folder, [arguments], [target_script_name], strict=strict
+        )[0]
+
+    def write_many(
+        self, target_folder, arguments_list, target_script_names=None, strict=True
+    ):
+        """Render the template for many sets of arguments in one folder
+
+        All scripts are rendered before writing, so that a missing argument does not
+        leave a partial set of scripts.
+
+        Args:
+            target_folder (str): Where to write the scripts?
+            arguments_list (list): List of dictionaries of arguments
+            target_script_names (list, optional): Names of the scripts. Defaults to
+                `<source_script stem>_<index><suffix>`.
+            strict (bool, optional): Whether to raise an error if a placeholder has no
+                argument. Defaults to True.
+
+        Returns:
+            list: Paths to the scripts
+        """
+        if target_script_names is None:
+            stem, suffix = self.source_script.stem, self.source_script.suffix
+            target_script_names = [
+                f"{stem}_{i}{suffix}" for i in range(len(arguments_list))
+            ]
+        assert len(target_script_names) == len(
+            arguments_list
+        ), "target_script_names and arguments_list should have the same length"
+        rendered = [self.render(args, strict=strict) for args in arguments_list]
+
+        target_folder = Path(target_folder).expanduser()
+        python_scripts = []
+        for name, source in zip(target_script_names, rendered):
+            python_script = target_folder / name
+            with open(python_script, "w") as fhandle:
+                fhandle.write(source)
+            python_scripts.append(python_script)
+        return python_scripts
+
+
+@lru_cache(maxsize=32)
+def _cached_template(source_script, mtime_ns, size):
+    """Compiled template, reloaded when the source file changes"""
+    return ScriptTemplate(source_script)
 
 
 def python_script_from_template(
@@ -224,7 +823,8 @@ def python_script_from_template(
     """Create a python script from a template
 
     Arguments in the template should be of the form XXX_ARGUMENT_XXX. They will be
-    replaced by the value of `arguments["ARGUMENT"]`
+    replaced by the value of `arguments["ARGUMENT"]`. The parsed template is cached,
+    use `ScriptTemplate` to validate arguments or write many scripts at once.
 
     Args:
         target_folder (str): Where to write the script?
@@ -235,13 +835,80 @@ def python_script_from_template(
             Defaults to None.
     """
     source_script = Path(source_script)
-    if arguments is None:
-        arguments = {}
-    source = source_script.read_text()
-    for k, v in arguments.items():
-        source = source.replace(f'"XXX_{k.upper()}_XXX"', repr(v))
-    if target_script_name is None:
-        target_script_name = source_script.name
-    python_script = Path(target_folder) / target_script_name
-    with open(python_script, "w") as fhandle:
-        fhandle.write(source)
+    stat = source_script.stat()
+    template = _cached_template(str(source_script), stat.st_mtime_ns, stat.st_size)
+    template.write(
+        target_folder,
+        target_script_name=target_script_name,
+        arguments=arguments,
+        strict=False,
+    )
+
+
+def merge_profiles(slurm_folder, scripts_name, target_file=None, n_lines=30):
+    """Merge the profiles of all jobs of a batch into one hotspot report
+
+    Profiles are the files written by jobs submitted with the `profile` option of
+    `slurm_it`, named `<scripts_name>_<job_id>.<extension>` (or
+    `<scripts_name>_local.<extension>` when run outside of slurm).
+
+    Args:
+        slurm_folder (str): Folder containing the profile files
+        scripts_name (str): Name of the scripts that generated the profiles
+        target_file (str, optional): File to write the report to. Defaults to None.
+        n_lines (int, optional): Number of hotspots to report. Defaults to 30.
+
+    Returns:
+        str: The hotspot report
+    """
+    slurm_folder = Path(slurm_folder).expanduser()
+    # ignore the profiles of other scripts starting with scripts_name
+    name_pattern = re.compile(re.escape(scripts_name) + r"_(\d+|local)")
+    profile_files = {}
+    for profile, ext in PROFILE_EXTENSIONS.items():
+        files = sorted(
+            f
+            for f in slurm_folder.glob(f"{scripts_name}_*{ext}")
+            if name_pattern.fullmatch(f.name[: -len(ext)])
+        )
+        if files:
+            profile_files[profile] = files
+    if not profile_files:
+        raise FileNotFoundError(f"No profile for {scripts_name} in {slurm_folder}")
+
+    report = []
+    for profile, files in profile_files.items():
+        report.append(f"{profile} profile merged from {len(files)} jobs\n")
+        if profile == "cprofile":
+            import pstats
+
+            stream = io.StringIO()
+            stats = pstats.Stats(*[str(f) for f in files], stream=stream)
+            stats.sort_stats("cumulative").print_stats(n_lines)
+            report.append(stream.getvalue())
+        elif profile == "tracemalloc":
+            import tracemalloc
+
+            sizes = {}
+            for f in files:
+                snapshot = tracemalloc.Snapshot.load(str(f))
+                for stat in snapshot.statistics("lineno"):
+                    size, count = sizes.get(stat.traceback, (0, 0))
+                    sizes[stat.traceback] = (size + stat.size, count + stat.count)
+            hotspots = sorted(sizes.items(), key=lambda x: x[1][0], reverse=True)
+            for trace, (size, count) in hotspots[:n_lines]:
+                report.append(f"{trace}: size={size / 1024:.1f} KiB, count={count}\n")
+        elif profile == "pyinstrument":
+            from pyinstrument.renderers import ConsoleRenderer
+            from pyinstrument.session import Session
+
+            session = Session.load(str(files[0]))
+            for f in files[1:]:
+                session = Session.combine(session, Session.load(str(f)))
+            report.append(ConsoleRenderer(unicode=False, color=False).render(session))
+        report.append("\n")
+
+    report = "".join(report)
+    if target_file is not None:
+        Path(target_file).expanduser().write_text(report)
+    return report
@@ -0,0 +1,233 @@
+"""Telemetry of slurm submissions and jobs
+
+`run_slurm_batch` records the latency and outcome of each `sbatch` call in `TELEMETRY`.
+Queue wait, run time and final state of the submitted jobs are then collected from
+`sacct` with `Telemetry.update_jobs`, and everything can be exported as an OpenMetrics
+textfile or a json time series, or streamed to callbacks.
+"""
+import datetime
+import json
+import os
+import shlex
+import subprocess
+import time
+from pathlib import Path
+
+FINAL_STATES = [
+    "COMPLETED",
+    "FAILED",
+    "TIMEOUT",
+    "CANCELLED",
+    "OUT_OF_MEMORY",
+    "NODE_FAIL",
+    "PREEMPTED",
+    "BOOT_FAIL",
+    "DEADLINE",
+]
+
+
+def _parse_sacct_time(time_str):
+    if time_str in ("", "Unknown", "None"):
+        return None
+    return datetime.datetime.fromisoformat(time_str).timestamp()
+
+
+class Telemetry:
+    """Record slurm submissions and job statistics per function
+
+    Each record is an event dictionary with a "type" ("submission" or "job"), a
+    "timestamp" and a "label" (the name of the submitted function). Events are passed
+    to the callbacks as they are recorded.
+    """
+
+    def __init__(self):
+        self.events = []
+        self.jobs = {}
+        self.callbacks = []
+        self._exported = {}
+
+    def add_callback(self, callback):
+        """Add a function called with each new event
+
+        Args:
+            callback (callable): Function taking an event dictionary
+        """
+        self.callbacks.append(callback)
+
+    def reset(self):
+        """Forget all events and jobs"""
+        self.events = []
+        self.jobs = {}
+        self._exported = {}
+
+    def _add_event(self, event):
+        event["timestamp"] = time.time()
+        self.events.append(event)
+        for callback in self.callbacks:
+            callback(event)
+
+    def record_submission(self, label, duration, job_id=None, error=None):
+        """Record a call to sbatch
+
+        Args:
+            label (str): Name of the submitted function or script
+            duration (float): Duration of the sbatch call in seconds
+            job_id (str, optional): Job ID returned by sbatch. Defaults to None.
+            error (str, optional): Error message if sbatch failed. Defaults to None.
+        """
+        if job_id is not None:
+            self.jobs[job_id] = dict(label=label, state=None)
+        self._add_event(
+            dict(
+                type="submission",
+                label=label,
+                duration=duration,
+                job_id=job_id,
+                error=error,
+            )
+        )
+
+    def update_jobs(self, chunk_size=500):
+        """Query sacct for the jobs that have not finished yet
+
+        Jobs reaching a final state are recorded as "job" events with their queue
+        wait (submission to start) and run time in seconds.
+
+        Args:
+            chunk_size (int, optional): Maximum number of job IDs per sacct call.
+                Defaults to 500.
+        """
+        job_ids = [
+            j for j, job in self.jobs.items() if job["state"] not in FINAL_STATES
+        ]
+        for i in range(0, len(job_ids), chunk_size):
+            command = (
+                "sacct -X -P -n --format=JobID,State,ExitCode,Submit,Start,End -j "
+                + ",".join(job_ids[i : i + chunk_size])
+            )
+            procout = subprocess.check_output(shlex.split(command))
+            for line in procout.decode("utf-8").splitlines():
+                if not line.strip():
+                    continue
+                job_id, state, exit_code, submit, start, end = line.split("|")
+                if job_id not in self.jobs:
+                    continue
+                state = state.split(" ")[0]
+                job = self.jobs[job_id]
+                job["state"] = state
+                if state not in FINAL_STATES:
+                    continue
+                submit, start, end = [
+                    _parse_sacct_time(t) for t in (submit, start, end)
+                ]
+                self._add_event(
+                    dict(
+                        type="job",
+                        label=job["label"],
+                        job_id=job_id,
+                        state=state,
+                        exit_code=exit_code,
+                        queue_wait=start - submit if start is not None else None,
+                        run_time=end - start if None not in (start, end) else None,
+                    )
+                )
+
+    def summary(self):
+        """Summarise the events per function
+
+        Returns:
+            dict: For each label, a dictionary with the number of submissions and
+                errors, the total sbatch latency, the number of finished jobs per
+                state, and the total queue wait and run time of finished jobs
+        """
+        summary = {}
+        for event in self.events:
+            stats = summary.setdefault(
+                event["label"],
+                dict(
+                    submissions=0,
+                    errors=0,
+                    sbatch_seconds=0.0,
+                    states={},
+                    jobs_started=0,
+                    queue_wait_seconds=0.0,
+                    run_seconds=0.0,
+                ),
+            )
+            if event["type"] == "submission":
+                stats["submissions"] += 1
+                stats["errors"] += event["error"] is not None
+                stats["sbatch_seconds"] += event["duration"]
+            else:
+                states = stats["states"]
+                states[event["state"]] = states.get(event["state"], 0) + 1
+                if event["queue_wait"] is not None:
+                    stats["jobs_started"] += 1
+                    stats["queue_wait_seconds"] += event["queue_wait"]
+                    stats["run_seconds"] += event["run_time"] or 0.0
+        return summary
+
+    def to_openmetrics(self, target_file=None):
+        """Export the summary in OpenMetrics text format
+
+        Args:
+            target_file (str, optional): File to write, for instance for the textfile
+                collector of node_exporter. It is replaced atomically. Defaults to None.
+
+        Returns:
+            str: The metrics
+        """
+        summary = self.summary()
+        metrics = [
+            ("submissions", "counter", "sbatch calls", "_total", "submissions"),
+            ("submission_errors", "counter", "failed sbatch calls", "_total", "errors"),
+            ("sbatch_duration_seconds", "summary", "sbatch latency", "", None),
+            ("queue_wait_seconds", "summary", "submission to start", "", None),
+            ("run_seconds", "summary", "job run time", "", None),
+            ("jobs", "counter", "finished jobs per state", "_total", None),
+        ]
+        lines = []
+        for name, metric_type, help_txt, suffix, key in metrics:
+            name = f"znamutils_{name}"
+            lines.append(f"# TYPE {name} {metric_type}")
+            lines.append(f"# HELP {name} {help_txt}")
+            for label, stats in summary.items():
+                labels = f'function="{label}"'
+                if key is not None:
+                    lines.append(f"{name}{suffix}{{{labels}}} {stats[key]}")
+                elif name.endswith("sbatch_duration_seconds"):
+                    lines.append(f"{name}_count{{{labels}}} {stats['submissions']}")
+                    lines.append(f"{name}_sum{{{labels}}} {stats['sbatch_seconds']}")
+                elif name.endswith("_seconds"):
+                    total = stats[name[len("znamutils_") :]]
+                    lines.append(f"{name}_count{{{labels}}} {stats['jobs_started']}")
+                    lines.append(f"{name}_sum{{{labels}}} {total}")
+                else:
+                    for state, count in stats["states"].items():
+                        state_labels = f'{labels},state="{state}"'
+                        lines.append(f"{name}{suffix}{{{state_labels}}} {count}")
+        lines.append("# EOF")
+        txt = "\n".join(lines) + "\n"
+        if target_file is not None:
+            target_file = Path(target_file).expanduser()
+            tmp_file = target_file.with_name(f"{target_file.name}.{os.getpid()}.tmp")
+            tmp_file.write_text(txt)
+            os.replace(tmp_file, target_file)
+        return txt
+
+    def to_json(self, target_file):
+        """Append the events not exported yet to a json lines time series
+
+        Args:
+            target_file (str): File to append to, one json event per line
+        """
+        target_file = str(Path(target_file).expanduser())
+        first = self._exported.get(target_file, 0)
+        with open(target_file, "a") as fhandle:
+            for event in self.events[first:]:
+                fhandle.write(json.dumps(event) + "\n")
+        self._exported[target_file] = len(self.events)
+
+
+# default telemetry, used by slurm_helper
+TELEMETRY = Telemetry()